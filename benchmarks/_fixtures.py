@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Shared by the benchmarks. Importing it also adds the repository root to the path,
+# after an installed mtb, so the benchmarks run from anywhere: python benchmarks/[benchmark].py
+
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_toot(i):
+    now = datetime.now()
+    account = {"id": i, "display_name": "name", "acct": f"user{i}@example.social", "locked": False, "bot": False,
+               "discoverable": True, "group": False, "created_at": now, "note": "<p>note</p>",
+               "url": f"https://example.social/@user{i}", "avatar": "", "header": "", "followers_count": 10,
+               "following_count": 10, "statuses_count": 100, "last_status_at": now, "emojis": [], "fields": []}
+    media = [{"id": j, "type": "image", "url": "", "preview_url": "", "remote_url": "", "preview_remote_url": "",
+              "text_url": None, "meta": {"original": {"width": 640, "height": 480}}, "description": "", "blurhash": ""} for j in range(2)]
+    return {"id": i, "created_at": now, "edited_at": None, "content": "<p>Hello #world</p>", "reblog": None,
+            "sensitive": False, "spoiler_text": "", "visibility": "public", "replies_count": 1, "reblogs_count": 2,
+            "favourites_count": 3, "language": "en", "in_reply_to_id": None, "in_reply_to_account_id": None,
+            "account": account, "media_attachments": media,
+            "mentions": [{"id": 1, "username": "a", "url": "", "acct": "a"}], "tags": [{"name": "world"}],
+            "card": None, "poll": None, "uri": f"https://example.social/users/user{i}/statuses/{i}",
+            "url": "", "queried_at": now}
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compare exporting all columns with a narrow projection:
+# python benchmarks/export_columns.py [n_toots]
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _fixtures import make_toot
+from mtb import functions as mf
+
+narrow_columns = ["id", "created_at", "content", "language", "replies_count", "reblogs_count",
+                  "favourites_count", "user_acct", "user_followers_count", "hashtags", "uri", "instance_name"]
+
+
+def main():
+    n_toots = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    toots = [make_toot(i) for i in range(n_toots)]
+    full = min(timeit.repeat(lambda: mf.toots_to_lines(toots), number=1, repeat=3))
+    narrow = min(timeit.repeat(lambda: mf.toots_to_lines(
+        toots, columns=narrow_columns), number=1, repeat=3))
+    print(f"{n_toots} toots, {len(mf.key_names)} columns: {full:.3f}s")
+    print(f"{n_toots} toots, {len(narrow_columns)} columns: {narrow:.3f}s ({full / narrow:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compare holding sanitized toots as dicts with holding them as TootRows:
+# python benchmarks/toot_rows.py [n_toots]
+
+import os
+import sys
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _fixtures import make_toot
+from mtb import functions as mf
+
+
+def measure(sanitize, toots):
+    tracemalloc.start()
+    sanitized_toots = [sanitize(toot) for toot in toots]
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = snapshot.statistics("filename")
+    return sum([s.size for s in stats]), sum([s.count for s in stats]), len(sanitized_toots)
+
+
+def main():
+    n_toots = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    toots = [make_toot(i) for i in range(n_toots)]
+    for name, sanitize in [("dict", mf.sanitize_toot), ("TootRow", mf.sanitize_toot_row)]:
+        size, count, n = measure(sanitize, toots)
+        print(f"{name: <8} {size / n:8.0f} bytes and {count / n:5.1f} allocations per toot")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from array import array
 from bs4 import BeautifulSoup
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
 from requests.exceptions import ConnectTimeout
-from urllib.parse import urlparse
+from urllib.parse import quote, urlencode, urlparse
 import configparser
 import csv
+import hashlib
 import json
 import logging
 import mastodon
 import os
+import random
 import re
 import requests
+import shutil
+import sqlite3
 import sys
+import threading
 import time
 import warnings
 from pathlib import Path
@@ -32,7 +41,7 @@ file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 logger.setLevel(logging.INFO)
 
-key_names = ["id", "created_at", "edited_at", "content", "reblog", "sensitive", "spoiler_text", "visibility", "replies_count", "reblogs_count", "favourites_count", "language", "in_reply_to_id", "in_reply_to_account_id", "user_id", "user_name", "user_acct", "user_locked", "user_bot", "user_discoverable", "user_group", "user_created_at", "user_note", "user_url", "user_avatar", "user_header", "user_followers_count", "user_following_count", "user_statuses_count", "user_last_status_at", "user_emojis", "user_fields", "media_id", "media_type", "media_url", "media_preview_url", "media_remote_url", "media_preview_remote_url", "media_text_url", "media_meta", "media_description", "media_blurhash", "mentions_id", "mentions_username", "mentions_url", "mentions_acct", "hashtags", "card_url", "card_title", "card_description", "card_type", "card_author_name", "card_author_url", "card_provider_name", "card_provider_url", "card_html", "card_width", "card_height", "card_image", "card_embed_url", "card_blurhash", "poll_id", "poll_expires_at", "poll_expired", "poll_multiple", "poll_votes_count", "poll_voters_count", "poll_options", "poll_votes", "uri", "url", "instance_name", "queried_at"]
+key_names = ["id", "created_at", "edited_at", "content", "reblog", "sensitive", "spoiler_text", "visibility", "replies_count", "reblogs_count", "favourites_count", "language", "in_reply_to_id", "in_reply_to_account_id", "user_id", "user_name", "user_acct", "user_locked", "user_bot", "user_discoverable", "user_group", "user_created_at", "user_note", "user_url", "user_avatar", "user_header", "user_followers_count", "user_following_count", "user_statuses_count", "user_last_status_at", "user_emojis", "user_fields", "media_id", "media_type", "media_url", "media_preview_url", "media_remote_url", "media_preview_remote_url", "media_text_url", "media_meta", "media_description", "media_blurhash", "mentions_id", "mentions_username", "mentions_url", "mentions_acct", "hashtags", "card_url", "card_title", "card_description", "card_type", "card_author_name", "card_author_url", "card_provider_name", "card_provider_url", "card_html", "card_width", "card_height", "card_image", "card_embed_url", "card_blurhash", "poll_id", "poll_expires_at", "poll_expired", "poll_multiple", "poll_votes_count", "poll_voters_count", "poll_options", "poll_votes", "uri", "url", "instance_name", "queried_at", "tracked_tags"]
 
 account_key_names = ["id", "username", "acct", "display_name", "locked", "bot", "discoverable", "group", "created_at", "note", "url", "avatar",
                      "avatar_static", "header", "header_static", "followers_count", "following_count", "statuses_count", "last_status_at", "emojis", "fields", "queried_at"]
@@ -44,12 +53,28 @@ trends_key_names = {
     "links": ["url", "title", "description", "type", "author_name", "author_url", "provider_name", "provider_url", "html", "width", "height", "image", "embed_url", "blurhash"]
 }
 
+# sanitized toots are tuples with one field per column in key_names
+TootRow = namedtuple("TootRow", key_names)
+
+engagement_key_names = ["uri", "queried_at", "instance_name",
+                        "replies_count", "reblogs_count", "favourites_count"]
+
 USER_AGENT = "mastodon_toolbox/1.0 (+https://github.com/Kudusch/mastodon_toolbox)"
 
+ACCOUNT_STORE = "mtb_accounts.db"
+INSTANCE_STORE = "mtb_instances.db"
+HEALTH_FILE = "mtb_health.json"
+STATUS_STORE = "mtb_statuses.db"
+
 config = configparser.ConfigParser()
 config.read(Path(__file__).parents[5].joinpath("config.ini"))
 access_tokens = config["MASTODON"]
 
+api_pool = {}
+api_pool_lock = threading.Lock()
+
+account_cache = {}
+
 
 def get_datetime_range(toots):
     values = [t["created_at"] for t in toots]
@@ -96,7 +121,18 @@ def add_queried_at(toots):
     return toots
 
 
-def aggregate_timelines(files):
+def write_json_atomic(obj, file_name):
+    tmp_name = f"{file_name}.tmp"
+    with open(tmp_name, "w") as f:
+        json.dump(obj, f, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, file_name)
+
+
+def aggregate_timelines(files, sightings=None):
+    if sightings is None:
+        sightings = {}
     unique_toots = {}
     for fname in files:
         with open(f"{fname}", "r") as f:
@@ -110,12 +146,12 @@ def aggregate_timelines(files):
                         unique_toots[toot["uri"]] = [(instance, toot)]
 
     for uri, toots in unique_toots.items():
-        if len(toots) == 1:
+        if len(toots) == 1 and uri not in sightings:
             instance, toot = toots[0]
             instance = f"[\"{instance}\"]"
             toot["id"] = uri
         else:
-            instances = [i for i, t in toots]
+            instances = [i for i, t in toots] + sightings.get(uri, [])
             toot = sorted([t for i, t in toots], key=lambda t: (
                 t["replies_count"]+t["reblogs_count"]+t["favourites_count"]), reverse=True)[0]
             instance = json.dumps(instances)
@@ -148,233 +184,446 @@ def format_snowflake(sf):
     else:
         return (f"{datetime.fromtimestamp((int(sf)>>16)/1000):%Y-%m-%d}/{int(sf)}")
 
+def snowflake_from_datetime(dt):
+    return (int(round(dt.timestamp())) * 1000) << 16
+
+
+def get_id_shards(start_date, end_date, n_shards):
+    if isinstance(start_date, datetime):
+        start_date = snowflake_from_datetime(start_date)
+    if isinstance(end_date, datetime):
+        end_date = snowflake_from_datetime(end_date)
+    step = max((end_date - start_date) // n_shards, 1)
+    shards = []
+    for i in range(n_shards):
+        min_id = start_date + i * step
+        max_id = end_date if i == n_shards - 1 else min_id + step
+        if min_id >= end_date:
+            break
+        shards.append((min_id, max_id))
+    return shards
+
+
+def get_host(api_base):
+    if "://" in api_base:
+        return urlparse(api_base).netloc
+    return api_base.split("/")[0]
+
+
+class HealthRegistry:
+    # success rate, latency and last error per host, failing hosts are skipped
+    # until their backoff has passed and then probed again
+    # blocked or rejected crawlers count as failures, like server errors. Rate limits (429)
+    # do not, the clients wait them out
+    def __init__(self, file_name=None, failure_threshold=3, backoff=60, max_backoff=24*60*60, alpha=0.2, save_interval=30,
+                 failure_statuses=(401, 403, 410, 451)):
+        self.file_name = file_name
+        self.failure_threshold = failure_threshold
+        self.failure_statuses = failure_statuses
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.alpha = alpha
+        self.save_interval = save_interval
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.last_saved = time.time()
+        if file_name:
+            self.load(file_name)
+
+    def load(self, file_name):
+        with self.lock:
+            self.file_name = file_name
+            if os.path.isfile(file_name):
+                with open(file_name, "r") as f:
+                    self.hosts = json.load(f)
+
+    def save(self):
+        with self.lock:
+            if self.file_name and self.hosts:
+                write_json_atomic(self.hosts, self.file_name)
+            self.last_saved = time.time()
+
+    def get_entry(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {"successes": 0, "failures": 0, "latency": None, "last_error": None,
+                                "last_error_at": None, "last_success_at": None,
+                                "consecutive_failures": 0, "backoff": 0, "open_until": 0}
+        return self.hosts[host]
+
+    def record_success(self, host, latency):
+        with self.lock:
+            entry = self.get_entry(host)
+            entry["successes"] += 1
+            if entry["latency"] is None:
+                entry["latency"] = latency
+            else:
+                entry["latency"] = self.alpha * latency + (1 - self.alpha) * entry["latency"]
+            entry["last_success_at"] = time.time()
+            entry["consecutive_failures"] = 0
+            entry["backoff"] = 0
+            entry["open_until"] = 0
+        self.save_if_due()
+
+    def record_failure(self, host, error):
+        with self.lock:
+            entry = self.get_entry(host)
+            entry["failures"] += 1
+            entry["last_error"] = error
+            entry["last_error_at"] = time.time()
+            entry["consecutive_failures"] += 1
+            # a failed probe doubles the backoff
+            if entry["consecutive_failures"] >= self.failure_threshold:
+                entry["backoff"] = min(max(entry["backoff"] * 2, self.backoff), self.max_backoff)
+                entry["open_until"] = time.time() + entry["backoff"]
+                logger.warning(f"Skipping {host} for {entry['backoff']} seconds after {entry['consecutive_failures']} failures ({error})")
+        self.save_if_due()
+
+    def save_if_due(self):
+        if time.time() - self.last_saved >= self.save_interval:
+            self.save()
+
+    def is_failure(self, status_code):
+        return status_code >= 500 or status_code in self.failure_statuses
+
+    def is_available(self, api_base):
+        entry = self.hosts.get(get_host(api_base))
+        return entry is None or time.time() >= entry["open_until"]
+
+    def get_success_rate(self, api_base):
+        entry = self.hosts.get(get_host(api_base))
+        if not entry or not entry["successes"] + entry["failures"]:
+            return None
+        return entry["successes"] / (entry["successes"] + entry["failures"])
+
+    def rank(self, instances):
+        # available hosts first, the reliable and fast ones before the others
+        def key(api_base):
+            entry = self.hosts.get(get_host(api_base))
+            if not entry:
+                return (0, 0, 0)
+            success_rate = self.get_success_rate(api_base)
+            return (not self.is_available(api_base), -(success_rate if success_rate is not None else 1), entry["latency"] or 0)
+        return sorted(instances, key=key)
+
+
+health = HealthRegistry()
+
+
+class HealthSession(requests.Session):
+    # passed to every client, so each request is recorded and skipped hosts fail fast
+    def __init__(self, registry):
+        super().__init__()
+        self.registry = registry
+
+    def request(self, method, url, *args, **kwargs):
+        host = get_host(url)
+        if not self.registry.is_available(host):
+            raise requests.exceptions.ConnectionError(f"{host} is skipped after repeated failures")
+        start = time.time()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.registry.record_failure(host, f"{type(e).__name__}: {e}")
+            raise
+        if self.registry.is_failure(response.status_code):
+            self.registry.record_failure(host, f"HTTP {response.status_code}")
+        elif response.status_code != 429:
+            self.registry.record_success(host, time.time() - start)
+        return response
+
+
+def get_api(api_base, access_token=None, request_timeout=30, ratelimit_method="pace"):
+    # one client per host: creating a client costs a version check request
+    key = (api_base, access_token, request_timeout, ratelimit_method)
+    with api_pool_lock:
+        if key in api_pool:
+            return api_pool[key]
+    if not health.is_available(api_base):
+        raise mastodon.MastodonNetworkError(f"{api_base} is skipped after repeated failures")
+    api = mastodon.Mastodon(api_base_url=api_base, access_token=access_token, request_timeout=request_timeout,
+                            ratelimit_method=ratelimit_method, user_agent=USER_AGENT, session=HealthSession(health))
+    with api_pool_lock:
+        return api_pool.setdefault(key, api)
+
+
+class HostLimiter:
+    def __init__(self, max_per_host=2, min_interval=0):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self.semaphores = {}
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            semaphore = self.semaphores[host]
+        with semaphore:
+            if self.min_interval:
+                with self.lock:
+                    now = time.time()
+                    slot = max(now, self.next_slot.get(host, now))
+                    self.next_slot[host] = slot + self.min_interval
+                time.sleep(max(slot - now, 0))
+            yield
+
 # check moved_to
 
 
-def sanitize_toot(raw_toot, instance_name=None, parse_html=False):
-    toot = {
-        "id": raw_toot["id"],
-        "in_reply_to_id": raw_toot["in_reply_to_id"],
-        "in_reply_to_account_id": raw_toot["in_reply_to_account_id"],
-        "sensitive": raw_toot["sensitive"],
-        "spoiler_text": raw_toot["spoiler_text"],
-        "visibility": raw_toot["visibility"],
-        "language": raw_toot["language"],
-        "uri": raw_toot["uri"],
-        "url": raw_toot["url"],
-        "replies_count": raw_toot["replies_count"],
-        "reblogs_count": raw_toot["reblogs_count"],
-        "favourites_count": raw_toot["favourites_count"],
-        "reblog": raw_toot["reblog"],
-    }
+def format_datetime(value):
+    return format(value, "%Y-%m-%dT%H:%M:%S")
+
 
+def extract_content(raw_toot, instance_name=None, parse_html=False):
     if parse_html:
         try:
-            toot["content"] = parse_toot_html(raw_toot["content"])
-        except MarkupResemblesLocatorWarning:
-            pass
+            return parse_toot_html(raw_toot["content"])
         except:
-            toot["content"] = raw_toot["content"]
-    else:
-        toot["content"] = raw_toot["content"]
+            return raw_toot["content"]
+    return raw_toot["content"]
+
 
+def extract_created_at(raw_toot, instance_name=None, parse_html=False):
     try:
-        toot["created_at"] = format(
-            raw_toot["created_at"], "%Y-%m-%dT%H:%M:%S")
+        return format_datetime(raw_toot["created_at"])
     except:
-        toot["created_at"] = raw_toot["created_at"]
+        return raw_toot["created_at"]
+
+
+def extract_edited_at(raw_toot, instance_name=None, parse_html=False):
     if "edited_at" in raw_toot.keys() and raw_toot["edited_at"] is not None:
         try:
-            toot["edited_at"] = datetime.strptime(
-                f"{raw_toot['edited_at']} -0000", "%Y-%m-%dT%H:%M:%S.%fZ %z")
-            toot["edited_at"] = format(toot["edited_at"], "%Y-%m-%dT%H:%M:%S")
+            return format_datetime(datetime.strptime(
+                f"{raw_toot['edited_at']} -0000", "%Y-%m-%dT%H:%M:%S.%fZ %z"))
         except:
-            toot["edited_at"] = raw_toot["edited_at"]
-    else:
-        toot["edited_at"] = ""
+            return raw_toot["edited_at"]
+    return ""
 
-    toot["user_id"] = raw_toot["account"]["id"]
-    toot["user_name"] = raw_toot["account"]["display_name"]
-    toot["user_acct"] = raw_toot["account"]["acct"]
-    toot["user_locked"] = raw_toot["account"]["locked"]
-    toot["user_bot"] = raw_toot["account"]["bot"]
-    try:
-        toot["user_discoverable"] = raw_toot["account"]["discoverable"]
-    except:
-        toot["user_discoverable"] = ""
-    try:
-        toot["user_group"] = raw_toot["account"]["group"]
-    except:
-        toot["user_group"] = ""
 
+def extract_tracked_tags(raw_toot, instance_name=None, parse_html=False):
+    # only set on toots gathered with mtb hashtag --tags
+    if "tracked_tags" not in raw_toot:
+        return ""
+    return json.dumps(raw_toot["tracked_tags"])
+
+
+def extract_user_created_at(raw_toot, instance_name=None, parse_html=False):
     try:
-        toot["user_created_at"] = format(
-            raw_toot["account"]["created_at"], "%Y-%m-%dT%H:%M:%S")
+        return format_datetime(raw_toot["account"]["created_at"])
     except:
-        toot["user_created_at"] = raw_toot["account"]["created_at"].replace(
-            ".000Z", "")
-    toot["user_note"] = raw_toot["account"]["note"]
-    toot["user_url"] = raw_toot["account"]["url"]
-    toot["user_avatar"] = raw_toot["account"]["avatar"]
-    toot["user_header"] = raw_toot["account"]["header"]
-    toot["user_followers_count"] = raw_toot["account"]["followers_count"]
-    toot["user_following_count"] = raw_toot["account"]["following_count"]
-    toot["user_statuses_count"] = raw_toot["account"]["statuses_count"]
+        return raw_toot["account"]["created_at"].replace(".000Z", "")
+
+
+def extract_user_last_status_at(raw_toot, instance_name=None, parse_html=False):
     try:
         try:
-            toot["user_last_status_at"] = format(
-                raw_toot["account"]["last_status_at"], "%Y-%m-%dT%H:%M:%S")
+            return format_datetime(raw_toot["account"]["last_status_at"])
         except:
-            toot["user_last_status_at"] = raw_toot["account"]["last_status_at"].replace(
-                ".000Z", "")
+            return raw_toot["account"]["last_status_at"].replace(".000Z", "")
     except:
-        toot["user_last_status_at"] = ""
-    toot["user_emojis"] = json.dumps(raw_toot["account"]["emojis"])
-    toot["user_fields"] = json.dumps(raw_toot["account"]["fields"])
-
-    list_id = []
-    list_type = []
-    list_url = []
-    list_preview_url = []
-    list_remote_url = []
-    list_preview_remote_url = []
-    list_text_url = []
-    list_meta = []
-    list_description = []
-    list_blurhash = []
-    for media in raw_toot["media_attachments"]:
-        list_id.append(media["id"])
-        list_type.append(media["type"])
-        list_url.append(media["url"])
-        list_preview_url.append(media["preview_url"])
-        list_remote_url.append(media["remote_url"])
-        try:
-            list_preview_remote_url.append(media["preview_remote_url"])
-        except:
-            list_preview_remote_url.append("")
-        list_text_url.append(media["text_url"])
-        try:
-            list_meta.append(media["meta"])
-        except:
-            list_meta.append("")
-        list_description.append(media["description"])
-        try:
-            list_blurhash.append(media["blurhash"])
-        except:
-            list_blurhash.append("")
-
-    toot["media_id"] = json.dumps(list_id)
-    toot["media_type"] = json.dumps(list_type)
-    toot["media_url"] = json.dumps(list_url)
-    toot["media_preview_url"] = json.dumps(list_preview_url)
-    toot["media_remote_url"] = json.dumps(list_remote_url)
-    toot["media_preview_remote_url"] = json.dumps(list_preview_remote_url)
-    toot["media_text_url"] = json.dumps(list_text_url)
-    toot["media_meta"] = json.dumps(list_meta)
-    toot["media_description"] = json.dumps(list_description)
-    toot["media_blurhash"] = json.dumps(list_blurhash)
-
-    list_id = []
-    list_username = []
-    list_url = []
-    list_acct = []
-    for mention in raw_toot["mentions"]:
-        list_id.append(mention["id"])
-        list_username.append(mention["username"])
-        list_url.append(mention["url"])
-        list_acct.append(mention["acct"])
-
-    toot["mentions_id"] = json.dumps(list_id)
-    toot["mentions_username"] = json.dumps(list_username)
-    toot["mentions_url"] = json.dumps(list_url)
-    toot["mentions_acct"] = json.dumps(list_acct)
-
-    toot["hashtags"] = json.dumps([hashtag["name"]
-                                  for hashtag in raw_toot["tags"]])
-
-    if raw_toot["card"] is not None:
-        toot["card_url"] = raw_toot["card"]["url"]
-        toot["card_title"] = raw_toot["card"]["title"]
-        toot["card_description"] = raw_toot["card"]["description"]
-        toot["card_type"] = raw_toot["card"]["type"]
-        try:
-            toot["card_author_name"] = raw_toot["card"]["author_name"]
-        except:
-            toot["card_author_name"] = ""
-        toot["card_author_url"] = raw_toot["card"]["author_url"]
-        toot["card_provider_name"] = raw_toot["card"]["provider_name"]
-        toot["card_provider_url"] = raw_toot["card"]["provider_url"]
-        try:
-            toot["card_html"] = raw_toot["card"]["html"]
-        except:
-            toot["card_html"] = ""
-        toot["card_width"] = raw_toot["card"]["width"]
-        toot["card_height"] = raw_toot["card"]["height"]
-        toot["card_image"] = raw_toot["card"]["image"]
-        try:
-            toot["card_embed_url"] = raw_toot["card"]["embed_url"]
-        except:
-            toot["card_embed_url"] = ""
+        return ""
+
+
+def extract_poll_expires_at(raw_toot, instance_name=None, parse_html=False):
+    if raw_toot["poll"] is None:
+        return ""
+    try:
+        return format_datetime(raw_toot["poll"]["expires_at"])
+    except:
+        return ""
+
+
+def extract_queried_at(raw_toot, instance_name=None, parse_html=False):
+    if "queried_at" in raw_toot.keys():
         try:
-            toot["card_blurhash"] = raw_toot["card"]["blurhash"]
+            return format_datetime(raw_toot["queried_at"])
         except:
-            toot["card_blurhash"] = ""
-    else:
-        toot["card_url"] = ""
-        toot["card_title"] = ""
-        toot["card_description"] = ""
-        toot["card_type"] = ""
-        toot["card_author_name"] = ""
-        toot["card_author_url"] = ""
-        toot["card_provider_name"] = ""
-        toot["card_provider_url"] = ""
-        toot["card_html"] = ""
-        toot["card_width"] = ""
-        toot["card_height"] = ""
-        toot["card_image"] = ""
-        toot["card_embed_url"] = ""
-        toot["card_blurhash"] = ""
-
-    if raw_toot["poll"] is not None:
-        toot["poll_id"] = raw_toot["poll"]["id"]
+            return raw_toot["queried_at"].replace(".000Z", "")
+    return ""
+
+
+def extract_instance_name(raw_toot, instance_name=None, parse_html=False):
+    return instance_name if instance_name is not None else ""
+
+
+def toot_value(key):
+    def extract(raw_toot, instance_name=None, parse_html=False):
+        return raw_toot[key]
+    return extract
+
+
+def account_value(key, optional=False):
+    def extract(raw_toot, instance_name=None, parse_html=False):
         try:
-            toot["poll_expires_at"] = format(
-                raw_toot["poll"]["expires_at"], "%Y-%m-%dT%H:%M:%S")
+            return raw_toot["account"][key]
         except:
-            toot["poll_expires_at"] = ""
-        toot["poll_expired"] = raw_toot["poll"]["expired"]
-        toot["poll_multiple"] = raw_toot["poll"]["multiple"]
-        toot["poll_votes_count"] = raw_toot["poll"]["votes_count"]
-        toot["poll_voters_count"] = raw_toot["poll"]["voters_count"]
-        toot["poll_options"] = json.dumps(
-            [option["title"] for option in raw_toot["poll"]["options"]])
-        toot["poll_votes"] = json.dumps(
-            [option["votes_count"] for option in raw_toot["poll"]["options"]])
-    else:
-        toot["poll_id"] = ""
-        toot["poll_expires_at"] = ""
-        toot["poll_expired"] = ""
-        toot["poll_multiple"] = ""
-        toot["poll_votes_count"] = ""
-        toot["poll_voters_count"] = ""
-        toot["poll_options"] = ""
-        toot["poll_votes"] = ""
+            if optional:
+                return ""
+            raise
+    return extract
 
-    if "queried_at" in raw_toot.keys():
+
+def account_json(key):
+    def extract(raw_toot, instance_name=None, parse_html=False):
+        return json.dumps(raw_toot["account"][key])
+    return extract
+
+
+def list_json(list_key, key, optional=False):
+    def extract(raw_toot, instance_name=None, parse_html=False):
+        values = []
+        for item in raw_toot[list_key]:
+            try:
+                values.append(item[key])
+            except:
+                if not optional:
+                    raise
+                values.append("")
+        return json.dumps(values)
+    return extract
+
+
+def nested_value(parent, key, optional=False):
+    # card and poll fields are empty strings when there is no card or poll
+    def extract(raw_toot, instance_name=None, parse_html=False):
+        if raw_toot[parent] is None:
+            return ""
         try:
-            toot["queried_at"] = format(
-                raw_toot["queried_at"], "%Y-%m-%dT%H:%M:%S")
+            return raw_toot[parent][key]
         except:
-            toot["queried_at"] = raw_toot["queried_at"].replace(".000Z", "")
-    else:
-        toot["queried_at"] = ""
+            if optional:
+                return ""
+            raise
+    return extract
+
+
+def poll_options_json(key):
+    def extract(raw_toot, instance_name=None, parse_html=False):
+        if raw_toot["poll"] is None:
+            return ""
+        return json.dumps([option[key] for option in raw_toot["poll"]["options"]])
+    return extract
+
+
+toot_extractors = {
+    "id": toot_value("id"),
+    "created_at": extract_created_at,
+    "edited_at": extract_edited_at,
+    "content": extract_content,
+    "reblog": toot_value("reblog"),
+    "sensitive": toot_value("sensitive"),
+    "spoiler_text": toot_value("spoiler_text"),
+    "visibility": toot_value("visibility"),
+    "replies_count": toot_value("replies_count"),
+    "reblogs_count": toot_value("reblogs_count"),
+    "favourites_count": toot_value("favourites_count"),
+    "language": toot_value("language"),
+    "in_reply_to_id": toot_value("in_reply_to_id"),
+    "in_reply_to_account_id": toot_value("in_reply_to_account_id"),
+    "user_id": account_value("id"),
+    "user_name": account_value("display_name"),
+    "user_acct": account_value("acct"),
+    "user_locked": account_value("locked"),
+    "user_bot": account_value("bot"),
+    "user_discoverable": account_value("discoverable", optional=True),
+    "user_group": account_value("group", optional=True),
+    "user_created_at": extract_user_created_at,
+    "user_note": account_value("note"),
+    "user_url": account_value("url"),
+    "user_avatar": account_value("avatar"),
+    "user_header": account_value("header"),
+    "user_followers_count": account_value("followers_count"),
+    "user_following_count": account_value("following_count"),
+    "user_statuses_count": account_value("statuses_count"),
+    "user_last_status_at": extract_user_last_status_at,
+    "user_emojis": account_json("emojis"),
+    "user_fields": account_json("fields"),
+    "media_id": list_json("media_attachments", "id"),
+    "media_type": list_json("media_attachments", "type"),
+    "media_url": list_json("media_attachments", "url"),
+    "media_preview_url": list_json("media_attachments", "preview_url"),
+    "media_remote_url": list_json("media_attachments", "remote_url"),
+    "media_preview_remote_url": list_json("media_attachments", "preview_remote_url", optional=True),
+    "media_text_url": list_json("media_attachments", "text_url"),
+    "media_meta": list_json("media_attachments", "meta", optional=True),
+    "media_description": list_json("media_attachments", "description"),
+    "media_blurhash": list_json("media_attachments", "blurhash", optional=True),
+    "mentions_id": list_json("mentions", "id"),
+    "mentions_username": list_json("mentions", "username"),
+    "mentions_url": list_json("mentions", "url"),
+    "mentions_acct": list_json("mentions", "acct"),
+    "hashtags": list_json("tags", "name"),
+    "tracked_tags": extract_tracked_tags,
+    "card_url": nested_value("card", "url"),
+    "card_title": nested_value("card", "title"),
+    "card_description": nested_value("card", "description"),
+    "card_type": nested_value("card", "type"),
+    "card_author_name": nested_value("card", "author_name", optional=True),
+    "card_author_url": nested_value("card", "author_url"),
+    "card_provider_name": nested_value("card", "provider_name"),
+    "card_provider_url": nested_value("card", "provider_url"),
+    "card_html": nested_value("card", "html", optional=True),
+    "card_width": nested_value("card", "width"),
+    "card_height": nested_value("card", "height"),
+    "card_image": nested_value("card", "image"),
+    "card_embed_url": nested_value("card", "embed_url", optional=True),
+    "card_blurhash": nested_value("card", "blurhash", optional=True),
+    "poll_id": nested_value("poll", "id"),
+    "poll_expires_at": extract_poll_expires_at,
+    "poll_expired": nested_value("poll", "expired"),
+    "poll_multiple": nested_value("poll", "multiple"),
+    "poll_votes_count": nested_value("poll", "votes_count"),
+    "poll_voters_count": nested_value("poll", "voters_count"),
+    "poll_options": poll_options_json("title"),
+    "poll_votes": poll_options_json("votes_count"),
+    "uri": toot_value("uri"),
+    "url": toot_value("url"),
+    "instance_name": extract_instance_name,
+    "queried_at": extract_queried_at
+}
 
-    if instance_name is not None:
-        toot["instance_name"] = instance_name
+
+extractor_cache = {}
+
+
+def compile_extractor(columns=None):
+    # only the requested columns are computed, in the requested order
+    # compiled once per projection, sinks and toots_to_lines call this for every page
+    if not columns:
+        columns = key_names
+    columns = tuple(columns)
+    if columns in extractor_cache:
+        return extractor_cache[columns]
+    unknown_columns = [c for c in columns if c not in toot_extractors]
+    if unknown_columns:
+        raise ValueError(f"Unknown columns: {', '.join(unknown_columns)}")
+    duplicate_columns = sorted(set([c for c in columns if columns.count(c) > 1]))
+    if duplicate_columns:
+        raise ValueError(f"Duplicate columns: {', '.join(duplicate_columns)}")
+    extractors = [toot_extractors[c] for c in columns]
+    if list(columns) == key_names:
+        make_row = TootRow._make
     else:
-        toot["instance_name"] = ""
+        make_row = namedtuple("TootProjection", columns)._make
+
+    def extract_toot(raw_toot, instance_name=None, parse_html=False):
+        return make_row([extractor(raw_toot, instance_name, parse_html) for extractor in extractors])
+    extractor_cache[columns] = extract_toot
+    return extract_toot
+
+
+extract_all_columns = compile_extractor(key_names)
 
-    return toot
+
+def sanitize_toot_row(raw_toot, instance_name=None, parse_html=False):
+    return extract_all_columns(raw_toot, instance_name=instance_name, parse_html=parse_html)
+
+
+def sanitize_toot(raw_toot, instance_name=None, parse_html=False):
+    return sanitize_toot_row(raw_toot, instance_name=instance_name, parse_html=parse_html)._asdict()
 
 
 def instances_to_lines(queried_instances, parse_html=False, verbose=False):
@@ -526,27 +775,26 @@ def accounts_to_lines(queried_accounts, parse_html=False, verbose=False):
     return lines
 
 
-def toots_to_lines(queried_toots, parse_html=False, instance_name=None, verbose=False):
+def toots_to_lines(queried_toots, parse_html=False, instance_name=None, columns=None, verbose=False):
     lines = []
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
+    extract_toot = compile_extractor(columns) if columns else extract_all_columns
     if queried_toots:
         for toot in queried_toots:
             if type(toot) is list:
                 for t in toot:
                     try:
-                        sanitized_toot = sanitize_toot(
-                            t, parse_html=parse_html, instance_name=instance_name)
-                        lines.append([sanitized_toot[k] for k in key_names])
+                        lines.append(extract_toot(
+                            t, parse_html=parse_html, instance_name=instance_name))
                     except Exception as e:
                         logger.error(f"Error sanitizing toot: {str(e)}")
 
             else:
                 try:
-                    sanitized_toot = sanitize_toot(
-                        toot, parse_html=parse_html, instance_name=instance_name)
-                    lines.append([sanitized_toot[k] for k in key_names])
+                    lines.append(extract_toot(
+                        toot, parse_html=parse_html, instance_name=instance_name))
                 except Exception as e:
                     logger.error(f"Error sanitizing toot: {str(e)}")
     if verbose and logger.level >= 20:
@@ -554,7 +802,7 @@ def toots_to_lines(queried_toots, parse_html=False, instance_name=None, verbose=
     return lines
 
 
-def toots_to_csv(queried_toots, file_name, parse_html=False, instance_name=None, append=False, verbose=False):
+def toots_to_csv(queried_toots, file_name, parse_html=False, instance_name=None, append=False, columns=None, verbose=False):
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
@@ -570,11 +818,11 @@ def toots_to_csv(queried_toots, file_name, parse_html=False, instance_name=None,
         with open(file_name, file_mode, newline='') as f:
             writer = csv.writer(f, dialect="unix")
             if not append:
-                writer.writerow(key_names)
+                writer.writerow(columns if columns else key_names)
             elif append and os.path.getsize(file_name) == 0:
-                writer.writerow(key_names)
+                writer.writerow(columns if columns else key_names)
             parsed_toots = toots_to_lines(
-                queried_toots, parse_html=parse_html, instance_name=instance_name)
+                queried_toots, parse_html=parse_html, instance_name=instance_name, columns=columns)
             for toot in parsed_toots:
                 writer.writerow(toot)
         logger.info(f"{len(queried_toots)} toots written")
@@ -585,177 +833,714 @@ def toots_to_csv(queried_toots, file_name, parse_html=False, instance_name=None,
         logger.setLevel(logging.WARNING)
 
 
-def get_toots_reblogs(toots, request_timeout=15, verbose=False):
-    if verbose and logger.level >= 20:
-        logger.setLevel(logging.INFO)
+class TimelinesSink:
+    # writes the {instance: [toots]} layout of *_timelines.json page by page
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.f = None
+        self.instances = set()
+        self.current_instance = None
+        self.n_current = 0
+        self.n_toots = 0
 
-    reblogs = {}
+    def write(self, page, instance_name=None):
+        if not page:
+            return
+        if not self.f:
+            self.f = open(self.file_name, "w")
+            self.f.write("{")
+        if instance_name != self.current_instance or not self.instances:
+            if instance_name in self.instances:
+                raise ValueError(
+                    f"{instance_name} was already written to {self.file_name}")
+            if self.instances:
+                self.f.write("],")
+            self.f.write(f"{json.dumps(instance_name)}: [")
+            self.instances.add(instance_name)
+            self.current_instance = instance_name
+            self.n_current = 0
+        for toot in page:
+            if self.n_current:
+                self.f.write(",")
+            self.f.write(json.dumps(toot, default=str))
+            self.n_current += 1
+        self.n_toots += len(page)
+        self.f.flush()
+
+    def checkpoint(self):
+        # everything up to offset is durable, recover_timelines() closes it
+        if not self.f:
+            return None
+        os.fsync(self.f.fileno())
+        return {"file_name": self.file_name, "offset": self.f.tell()}
+
+    def close(self):
+        if self.f:
+            self.f.write("]}")
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def truncate_file(file_name, offset):
+    with open(file_name, "r+") as f:
+        f.truncate(offset)
+
+
+def recover_timelines(file_name, offset):
+    truncate_file(file_name, offset)
+    with open(file_name, "a") as f:
+        f.write("]}")
+
+
+class UriSet:
+    # 64 bit hashes of every stored uri, false positives are negligible
+    # every commit is a generation, so hashes of pages a recovery removed again can be rolled back
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.db = sqlite3.connect(file_name)
+        self.db.execute("CREATE TABLE IF NOT EXISTS uris (hash INTEGER PRIMARY KEY, generation INTEGER DEFAULT 0)")
+        if "generation" not in [c[1] for c in self.db.execute("PRAGMA table_info(uris)")]:
+            self.db.execute("ALTER TABLE uris ADD COLUMN generation INTEGER DEFAULT 0")
+        self.db.commit()
+        self.committed = self.db.execute("SELECT MAX(generation) FROM uris").fetchone()[0] or 0
+        self.generation = self.committed + 1
+
+    def add(self, uri):
+        digest = hashlib.blake2b(uri.encode(), digest_size=8).digest()
+        cursor = self.db.execute("INSERT OR IGNORE INTO uris VALUES (?, ?)",
+                                 (int.from_bytes(digest, "big", signed=True), self.generation))
+        return cursor.rowcount == 1
+
+    def split(self, toots):
+        new_toots = []
+        seen_toots = []
+        for toot in toots:
+            if self.add(toot["uri"]):
+                new_toots.append(toot)
+            else:
+                seen_toots.append(toot)
+        return new_toots, seen_toots
 
-    if not toots:
-        logger.warning(f"No toots provided, nothing to do")
-        return reblogs
+    def commit(self):
+        self.db.commit()
+        self.committed = self.generation
+        self.generation += 1
 
-    for t in toots:
-        reblogs[t["uri"]] = {
-            "reblogs": [],
-            "source": None
-        }
+    def rollback(self, generation):
+        self.db.execute("DELETE FROM uris WHERE generation > ?", (generation,))
+        self.db.commit()
+        self.committed = generation
+        self.generation = generation + 1
+
+    def close(self):
+        self.db.close()
+
+
+class SightingsSink:
+    # (uri, instance, queried_at) rows for toots that are already stored
+    def __init__(self, file_name):
+        self.file_name = file_name
+        write_header = not os.path.isfile(file_name) or os.path.getsize(file_name) == 0
+        self.f = open(file_name, "a", newline="")
+        self.writer = csv.writer(self.f, dialect="unix")
+        if write_header:
+            self.writer.writerow(["uri", "instance_name", "queried_at"])
+        self.n_items = 0
+
+    def write(self, page, instance_name=None):
+        for toot in page:
+            self.writer.writerow(
+                [toot["uri"], instance_name, format(toot["queried_at"], "%Y-%m-%dT%H:%M:%S")])
+        self.n_items += len(page)
+        self.f.flush()
+
+    def checkpoint(self):
+        os.fsync(self.f.fileno())
+        return {"file_name": self.file_name, "offset": self.f.tell()}
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EngagementStore:
+    # toot bodies are stored once, every observation is a row of integers
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.db = sqlite3.connect(file_name)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS instances (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS toots (id INTEGER PRIMARY KEY, uri TEXT UNIQUE, toot TEXT);
+            CREATE TABLE IF NOT EXISTS observations (toot_id INTEGER, instance_id INTEGER, queried_at INTEGER,
+                replies_count INTEGER, reblogs_count INTEGER, favourites_count INTEGER);
+            CREATE INDEX IF NOT EXISTS observations_toot ON observations (toot_id, queried_at);
+        """)
+        self.db.commit()
+        self.instance_ids = dict(
+            [(name, i) for i, name in self.db.execute("SELECT id, name FROM instances")])
+
+    def get_instance_id(self, instance_name):
+        if instance_name not in self.instance_ids:
+            self.db.execute(
+                "INSERT OR IGNORE INTO instances (name) VALUES (?)", (instance_name,))
+            self.instance_ids[instance_name] = self.db.execute(
+                "SELECT id FROM instances WHERE name = ?", (instance_name,)).fetchone()[0]
+        return self.instance_ids[instance_name]
+
+    def add(self, toots, instance_name=None):
+        instance_id = self.get_instance_id(instance_name)
+        for toot in toots:
+            self.db.execute("INSERT OR IGNORE INTO toots (uri, toot) VALUES (?, ?)",
+                            (toot["uri"], json.dumps(toot, default=str)))
+            toot_id = self.db.execute(
+                "SELECT id FROM toots WHERE uri = ?", (toot["uri"],)).fetchone()[0]
+            try:
+                queried_at = int(toot["queried_at"].timestamp())
+            except:
+                queried_at = int(time.time())
+            self.db.execute("INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?)", (toot_id, instance_id, queried_at,
+                            toot["replies_count"], toot["reblogs_count"], toot["favourites_count"]))
+
+    def commit(self):
+        self.db.commit()
+
+    def iter_observations(self):
+        for row in self.db.execute("""
+                SELECT toots.uri, observations.queried_at, instances.name, replies_count, reblogs_count, favourites_count
+                FROM observations JOIN toots ON toots.id = toot_id JOIN instances ON instances.id = instance_id
+                ORDER BY toot_id, observations.queried_at"""):
+            yield [row[0], datetime.fromtimestamp(row[1]).strftime("%Y-%m-%dT%H:%M:%S")] + list(row[2:])
+
+    def iter_trajectories(self):
+        trajectory = []
+        for observation in self.iter_observations():
+            if trajectory and trajectory[-1][0] != observation[0]:
+                yield self.get_toot(trajectory[0][0]), trajectory
+                trajectory = []
+            trajectory.append(observation)
+        if trajectory:
+            yield self.get_toot(trajectory[0][0]), trajectory
+
+    def get_toot(self, uri):
+        row = self.db.execute(
+            "SELECT toot FROM toots WHERE uri = ?", (uri,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def close(self):
+        self.db.close()
+
+
+def read_sightings(file_name):
+    sightings = {}
+    with open(file_name, "r", newline="") as f:
+        for uri, instance_name, queried_at in csv.reader(f, dialect="unix"):
+            if uri == "uri":
+                continue
+            sightings.setdefault(uri, []).append(instance_name)
+    return sightings
+
+
+class JSONLinesSink:
+    def __init__(self, file_name, append=False):
+        self.file_name = file_name
+        self.f = open(file_name, "a" if append else "w")
+        self.n_items = 0
+
+    def write(self, page, instance_name=None):
+        for item in page:
+            if instance_name is not None:
+                item["queried_instance"] = instance_name
+            self.f.write(json.dumps(item, default=str))
+            self.f.write("\n")
+        self.n_items += len(page)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TootsCSVSink:
+    def __init__(self, file_name, parse_html=False, append=False, columns=None):
+        self.file_name = file_name
+        self.parse_html = parse_html
+        self.columns = columns
+        write_header = not append or not os.path.isfile(
+            file_name) or os.path.getsize(file_name) == 0
+        self.f = open(file_name, "a" if append else "w", newline="")
+        self.writer = csv.writer(self.f, dialect="unix")
+        if write_header:
+            self.writer.writerow(columns if columns else key_names)
+        self.n_items = 0
+
+    def write(self, page, instance_name=None):
+        for line in toots_to_lines(page, parse_html=self.parse_html, instance_name=instance_name, columns=self.columns):
+            self.writer.writerow(line)
+        self.n_items += len(page)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AccountsCSVSink:
+    def __init__(self, file_name, parse_html=False, extra_columns=None):
+        # file_name may also be an open file, e.g. from argparse.FileType
+        if hasattr(file_name, "write"):
+            self.f = file_name
+        else:
+            self.f = open(file_name, "w", newline="")
+        self.parse_html = parse_html
+        self.writer = csv.writer(self.f, dialect="unix")
+        self.writer.writerow(account_key_names + (extra_columns or []))
+        self.n_items = 0
+
+    def write(self, page, instance_name=None, extra_values=None):
+        for line in accounts_to_lines(page, parse_html=self.parse_html):
+            self.writer.writerow(line + (extra_values or []))
+        self.n_items += len(page)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+partition_keys = {
+    "created_date": lambda toot, instance_name: str(toot["created_at"])[:10],
+    "instance_name": lambda toot, instance_name: instance_name,
+    "language": lambda toot, instance_name: toot.get("language"),
+}
+
+
+class PartitionedSink:
+    # Hive-style tree of key=value directories, at most max_open_files are kept open at once
+    def __init__(self, dir_name, partition_by, parse_html=False, columns=None, file_format="csv", max_open_files=64):
+        unknown_keys = [k for k in partition_by if k not in partition_keys]
+        if unknown_keys:
+            raise ValueError(f"Unknown partition keys: {', '.join(unknown_keys)}")
+        self.dir_name = dir_name
+        self.partition_by = partition_by
+        self.parse_html = parse_html
+        self.columns = columns
+        self.file_format = file_format
+        self.max_open_files = max_open_files
+        self.part_name = f"part-{int(datetime.now().timestamp())}.{'csv' if file_format == 'csv' else 'jsonl'}"
+        if file_format == "json" and columns:
+            self.extract_toot = compile_extractor(columns)
+        self.files = OrderedDict()
+        self.partitions = set()
+        self.n_items = 0
+
+    def get_path(self, values):
+        # same escaping as Hive, missing values go to its default partition
+        parts = [f"{k}={quote(str(v), safe='') if v not in [None, ''] else '__HIVE_DEFAULT_PARTITION__'}"
+                 for k, v in zip(self.partition_by, values)]
+        return os.path.join(self.dir_name, *parts, self.part_name)
+
+    def get_file(self, values):
+        file_name = self.get_path(values)
+        if file_name in self.files:
+            self.files.move_to_end(file_name)
+            return self.files[file_name]
+        if len(self.files) >= self.max_open_files:
+            self.files.popitem(last=False)[1][0].close()
+        # a partition closed earlier is continued, not overwritten
+        is_new = file_name not in self.partitions
+        if is_new:
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            self.partitions.add(file_name)
+        f = open(file_name, "w" if is_new else "a", newline="")
+        writer = csv.writer(f, dialect="unix") if self.file_format == "csv" else None
+        if is_new and writer:
+            writer.writerow(self.columns if self.columns else key_names)
+        self.files[file_name] = (f, writer)
+        return self.files[file_name]
+
+    def write(self, page, instance_name=None, partition_instance=None):
+        # partition_instance replaces instance_name as partition value, e.g. for aggregated toots
+        if partition_instance is None:
+            partition_instance = instance_name
+        groups = {}
+        for toot in page:
+            values = tuple(partition_keys[k](toot, partition_instance) for k in self.partition_by)
+            groups.setdefault(values, []).append(toot)
+        for values, toots in groups.items():
+            f, writer = self.get_file(values)
+            if writer:
+                writer.writerows(toots_to_lines(toots, parse_html=self.parse_html, instance_name=instance_name, columns=self.columns))
+            else:
+                for toot in toots:
+                    if self.columns:
+                        toot = self.extract_toot(toot, instance_name=instance_name, parse_html=self.parse_html)._asdict()
+                    toot["queried_instance"] = instance_name
+                    f.write(json.dumps(toot, default=str))
+                    f.write("\n")
+        self.n_items += len(page)
+
+    def close(self):
+        for f, writer in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
+
+def get_toot_sources(toots, request_timeout=15, verbose=False):
+    # current state of every toot, fetched once and shared by all interaction kinds
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    sources = {}
+    for t in toots:
         try:
             api_base = get_home_instance(t)
             home_id = get_home_id(t)
-            api = mastodon.Mastodon(api_base_url=api_base, access_token=None,
-                                    request_timeout=request_timeout, user_agent=USER_AGENT)
+            api = get_api(api_base, request_timeout=request_timeout, ratelimit_method="wait")
         except:
             logger.warning(f"Issues with {t['uri']}")
-            reblogs[t["uri"]]["source"] = "error"
-            next
-
-        try:
-            reblogs[t["uri"]]["source"] = api.status(home_id)
-        except:
-            reblogs[t["uri"]]["source"] = "deleted"
-
+            sources[t["uri"]] = "error"
+            continue
         try:
-            new_page = api.status_reblogged_by(home_id)
-            if new_page:
-                reblogs[t["uri"]]["reblogs"].extend(new_page)
-            while new_page:
-                new_page = api.fetch_next(new_page)
-                if new_page:
-                    reblogs[t["uri"]]["reblogs"].extend(new_page)
+            sources[t["uri"]] = api.status(home_id)
         except:
-            pass
-
-        logger.info(
-            f"Retrieved {len(reblogs[t['uri']]['reblogs'])} reblogs for {t['uri']}")
+            sources[t["uri"]] = "deleted"
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
 
-    return reblogs
+    return sources
 
 
-def get_toots_favourites(toots, request_timeout=15, verbose=False):
-    if verbose and logger.level >= 20:
-        logger.setLevel(logging.INFO)
+def is_unchanged(source, previous, count_key):
+    if not isinstance(source, dict) or not previous or not isinstance(previous.get("source"), dict):
+        return False
+    return source[count_key] == previous["source"][count_key]
 
-    favs = {}
+
+def page_new_accounts(api, page, known=None):
+    # pages are newest first, stop at the first page reaching known accounts
+    if known is None:
+        known = set()
+    accounts = []
+    for page in iter_pages(api, page):
+        accts = [acct_to_string(account) for account in page]
+        accounts.extend([account for acct, account in zip(accts, page) if acct not in known])
+        if known.intersection(accts):
+            break
+    return accounts
+
+
+def get_toots_accounts(toots, kind, count_key, get_first_page, request_timeout=15, store=None,
+                       sources=None, previous=None, verbose=False):
+    accounts = {}
 
     if not toots:
         logger.warning(f"No toots provided, nothing to do")
-        return favs
+        return accounts
+
+    if not previous:
+        previous = {}
+    if not sources:
+        sources = {}
 
+    n_unchanged = 0
     for t in toots:
-        favs[t["uri"]] = {
-            "favourites": [],
-            "source": None
+        accounts[t["uri"]] = {
+            kind: [],
+            "source": sources.get(t["uri"])
         }
 
+        previous_toot = previous.get(t["uri"])
+        if is_unchanged(accounts[t["uri"]]["source"], previous_toot, count_key):
+            accounts[t["uri"]][kind] = previous_toot[kind]
+            n_unchanged += 1
+            continue
+
         try:
             api_base = get_home_instance(t)
             home_id = get_home_id(t)
-            api = mastodon.Mastodon(api_base_url=api_base, access_token=None,
-                                    request_timeout=request_timeout, user_agent=USER_AGENT)
+            api = get_api(api_base, request_timeout=request_timeout, ratelimit_method="wait")
         except:
             logger.warning(f"Issues with {t['uri']}")
-            favs[t["uri"]]["source"] = "error"
-            next
+            accounts[t["uri"]]["source"] = "error"
+            continue
 
-        try:
-            favs[t["uri"]]["source"] = api.status(home_id)
-        except:
-            favs[t["uri"]]["source"] = "deleted"
+        if accounts[t["uri"]]["source"] is None:
+            try:
+                accounts[t["uri"]]["source"] = api.status(home_id)
+            except:
+                accounts[t["uri"]]["source"] = "deleted"
+
+        # a lower count means accounts were removed, which paging cannot detect
+        known = []
+        source = accounts[t["uri"]]["source"]
+        if previous_toot and isinstance(source, dict) and isinstance(previous_toot.get("source"), dict):
+            if source[count_key] >= previous_toot["source"][count_key]:
+                known = previous_toot[kind]
 
         try:
-            new_page = api.status_favourited_by(home_id)
-            if new_page:
-                favs[t["uri"]]["favourites"].extend(new_page)
-            while new_page:
-                new_page = api.fetch_next(new_page)
-                if new_page:
-                    favs[t["uri"]]["favourites"].extend(new_page)
+            new_accounts = page_new_accounts(api, get_first_page(api, home_id),
+                                             known=set([acct_to_string(a) for a in known]))
         except:
-            pass
+            new_accounts = []
 
+        if store:
+            # remote copies are replaced by fresh snapshots from the accounts' home instances
+            store.put_many(new_accounts, source=api_base)
+            new_accounts = [store.get_home(a) or a for a in new_accounts]
+        accounts[t["uri"]][kind] = new_accounts + known
         logger.info(
-            f"Retrieved {len(favs[t['uri']]['favourites'])} favourites for {t['uri']}")
+            f"Retrieved {len(new_accounts)} new {kind} for {t['uri']}")
+
+    if previous:
+        logger.info(f"Kept {kind} of {n_unchanged} unchanged toots")
+
+    return accounts
+
+
+def get_toots_reblogs(toots, request_timeout=15, store=None, sources=None, previous=None, verbose=False):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    reblogs = get_toots_accounts(toots, "reblogs", "reblogs_count",
+                                 lambda api, home_id: api.status_reblogged_by(home_id),
+                                 request_timeout=request_timeout, store=store, sources=sources, previous=previous)
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
 
-    return favs
+    return reblogs
 
 
-def get_toots_context(toots, request_timeout=15, save_toots=False, parse_html=False, verbose=False):
+def get_toots_favourites(toots, request_timeout=15, store=None, sources=None, previous=None, verbose=False):
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
-    context = {}
+    favs = get_toots_accounts(toots, "favourites", "favourites_count",
+                              lambda api, home_id: api.status_favourited_by(home_id),
+                              request_timeout=request_timeout, store=store, sources=sources, previous=previous)
 
-    if not toots:
-        logger.warning(f"No toots provided, nothing to do")
-        return context
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
 
-    for t in toots:
-        context[t["uri"]] = {
-            "ancestors": [],
-            "descendants": [],
-            "source": None
-        }
+    return favs
 
+
+# status_context without a token returns at most this many ancestors and descendants, down to this depth
+CONTEXT_LIMITS = {"ancestors": 40, "descendants": 60, "depth": 20}
+
+
+class ContextEngine:
+    # reply tree of every fetched conversation, toots whose whole subtree
+    # is already known are answered without another status_context request
+    def __init__(self, request_timeout=15, store=None):
+        self.request_timeout = request_timeout
+        self.store = store
+        self.statuses = {}
+        self.instances = {}
+        self.parents = {}
+        self.children = {}
+        self.complete = set()
+
+    def add_statuses(self, statuses, api_base, ids=None):
+        # in_reply_to_id refers to ids of the instance the context came from
+        ids = dict(ids) if ids else {}
+        ids.update([(s["id"], s["uri"]) for s in statuses])
+        for status in statuses:
+            uri = status["uri"]
+            if uri not in self.statuses:
+                self.statuses[uri] = status
+                self.instances[uri] = api_base
+            parent = ids.get(status["in_reply_to_id"])
+            if parent and uri not in self.parents:
+                self.parents[uri] = parent
+                self.children.setdefault(parent, []).append(uri)
+
+    def get_ancestors(self, uri):
+        ancestors = []
+        while uri in self.parents and len(ancestors) < len(self.parents):
+            uri = self.parents[uri]
+            if uri in self.statuses:
+                ancestors.append(self.statuses[uri])
+        return ancestors[::-1]
+
+    def get_descendants(self, uri):
+        descendants = []
+        seen = set([uri])
+        stack = list(reversed(self.children.get(uri, [])))
+        while stack:
+            uri = stack.pop()
+            if uri in seen:
+                continue
+            seen.add(uri)
+            descendants.append(self.statuses[uri])
+            stack.extend(reversed(self.children.get(uri, [])))
+        return descendants
+
+    def get_depth(self, uri):
+        depth = 0
+        level = [uri]
+        seen = set(level)
+        while level:
+            level = [c for u in level for c in self.children.get(u, []) if c not in seen]
+            seen.update(level)
+            if level:
+                depth += 1
+        return depth
+
+    def get_context(self, toot, source=None):
+        uri = toot["uri"]
+        if uri in self.complete:
+            logger.info(f"Context for {uri} is already known")
+            return {
+                "ancestors": self.get_ancestors(uri),
+                "descendants": self.get_descendants(uri),
+                "source": self.statuses.get(uri, "deleted")
+            }
+
+        context = {"ancestors": [], "descendants": [], "source": None}
         try:
-            api_base = get_home_instance(t)
-            home_id = get_home_id(t)
+            api_base = get_home_instance(toot)
+            home_id = get_home_id(toot)
             if api_base in access_tokens.keys():
                 access_token = access_tokens[api_base]
             else:
                 access_token = None
-            api = mastodon.Mastodon(api_base_url=api_base, access_token=access_token, request_timeout=request_timeout, user_agent=USER_AGENT)
+            api = get_api(api_base, access_token=access_token,
+                          request_timeout=self.request_timeout, ratelimit_method="wait")
         except:
-            logger.warning(f"Issues with {t['uri']}")
-            context[t["uri"]]["source"] = "error"
-            next
+            logger.warning(f"Issues with {uri}")
+            context["source"] = "error"
+            return context
 
-        try:
-            context[t["uri"]]["source"] = api.status(home_id)
-        except:
-            context[t["uri"]]["source"] = "deleted"
+        context["source"] = source
+        if context["source"] is None:
+            try:
+                context["source"] = api.status(home_id)
+            except:
+                context["source"] = "deleted"
 
         try:
-            new_page = api.status_context(home_id)
-            if new_page:
-                context[t["uri"]]["ancestors"].extend(new_page["ancestors"])
-                context[t["uri"]]["descendants"].extend(
-                    new_page["descendants"])
-            while new_page:
-                new_page = api.fetch_next(new_page)
-                if new_page:
-                    context[t["uri"]]["ancestors"].extend(
-                        new_page["ancestors"])
-                    context[t["uri"]]["descendants"].extend(
-                        new_page["descendants"])
+            fetched = api.status_context(home_id)
         except:
-            pass
+            fetched = None
+        statuses = []
+        if isinstance(context["source"], dict):
+            statuses.append(context["source"])
+        if fetched:
+            statuses.extend(fetched["ancestors"] + fetched["descendants"])
+        self.add_statuses(statuses, api_base, ids={int(home_id): uri})
+        if fetched:
+            self.complete.add(uri)
+            # subtrees of a truncated context are incomplete and are requested again for later toots
+            truncated = not access_token and (
+                len(fetched["ancestors"]) >= CONTEXT_LIMITS["ancestors"]
+                or len(fetched["descendants"]) >= CONTEXT_LIMITS["descendants"]
+                or self.get_depth(uri) >= CONTEXT_LIMITS["depth"])
+            if not truncated:
+                self.complete.update([s["uri"] for s in fetched["descendants"]])
+            context["ancestors"] = self.get_ancestors(uri)
+            context["descendants"] = self.get_descendants(uri)
+            if self.store:
+                self.store.put_many([s["account"] for s in fetched["ancestors"] + fetched["descendants"]], source=api_base)
+        return context
 
+    def get_context_type(self, uri, source_uris):
+        # a toot below any input toot is a descendant, everything above the input toots an ancestor
+        if uri in source_uris:
+            return "source"
+        seen = set([uri])
+        while uri in self.parents and self.parents[uri] not in seen:
+            uri = self.parents[uri]
+            if uri in source_uris:
+                return "descendant"
+            seen.add(uri)
+        return "ancestor"
+
+    def write_csv(self, file_name, source_uris=None, parse_html=False):
+        # every toot once, the reply edges are in in_reply_to_uri
+        if source_uris is None:
+            source_uris = set()
+        with open(file_name, "w") as f:
+            writer = csv.writer(f, dialect="unix")
+            writer.writerow(key_names + ["in_reply_to_uri", "context_type"])
+            for uri, status in self.statuses.items():
+                for line in toots_to_lines([status], parse_html=parse_html, instance_name=self.instances[uri]):
+                    writer.writerow([*line, self.parents.get(uri, ""),
+                                     self.get_context_type(uri, source_uris)])
+        return len(self.statuses)
+
+
+def get_toots_context(toots, request_timeout=15, save_toots=False, parse_html=False, store=None,
+                      sources=None, previous=None, verbose=False):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    context = {}
+
+    if not toots:
+        logger.warning(f"No toots provided, nothing to do")
+        return context
+
+    if not previous:
+        previous = {}
+    if not sources:
+        sources = {}
+
+    for t in toots:
+        context[t["uri"]] = None
+        previous_toot = previous.get(t["uri"])
+        if is_unchanged(sources.get(t["uri"]), previous_toot, "replies_count"):
+            context[t["uri"]] = {
+                "ancestors": previous_toot["ancestors"],
+                "descendants": previous_toot["descendants"],
+                "source": sources[t["uri"]]
+            }
+
+    # earlier toots first, so that later replies are found in their threads
+    engine = ContextEngine(request_timeout=request_timeout, store=store)
+    for t in sorted(toots, key=lambda t: str(t.get("created_at", ""))):
+        if context[t["uri"]] is not None:
+            continue
+        context[t["uri"]] = engine.get_context(t, source=sources.get(t["uri"]))
         logger.info(
             f"Retrieved {len(context[t['uri']]['ancestors'])} ancestors and {len(context[t['uri']]['descendants'])} descendants for {t['uri']}")
 
     if save_toots:
-        with open("context_toots.csv", "w") as f:
-            writer = csv.writer(f, dialect="unix")
-            writer.writerow(key_names + ["context_type"])
-            for uri, context_toots in context.items():
-                instance_name = urlparse(uri).netloc
-                ancestors = context_toots["ancestors"]
-                descendants = context_toots["descendants"]
-                source = context_toots["source"]
-                for toot in toots_to_lines(ancestors, parse_html=parse_html, instance_name=instance_name, verbose=False):
-                    writer.writerow(toot + ["ancestor"])
-                for toot in toots_to_lines(descendants, parse_html=parse_html, instance_name=instance_name, verbose=False):
-                    writer.writerow(toot + ["descendant"])
-                for toot in toots_to_lines([source], parse_html=parse_html, instance_name=instance_name, verbose=False):
-                    writer.writerow(toot + ["source"])
+        n_toots = engine.write_csv("context_toots.csv", source_uris=set(context.keys()), parse_html=parse_html)
+        logger.info(f"Wrote {n_toots} unique context toots to context_toots.csv")
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
@@ -763,16 +1548,154 @@ def get_toots_context(toots, request_timeout=15, save_toots=False, parse_html=Fa
     return context
 
 
-def get_account_followers(account_url, max_followers=None, verbose=False, request_timeout=15):
+def iter_toots_interactions(toots, request_timeout=15, store=None, previous=None, engine=None, verbose=False):
+    # one toot at a time, without an engine the reply tree of each toot is dropped after it is yielded
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
+    if not previous:
+        previous = {}
+
+    for t in toots:
+        sources = get_toot_sources([t], request_timeout=request_timeout)
+        reblogs = get_toots_accounts([t], "reblogs", "reblogs_count",
+                                     lambda api, home_id: api.status_reblogged_by(home_id),
+                                     request_timeout=request_timeout, store=store, sources=sources,
+                                     previous=previous.get("reblogs"))
+        favourites = get_toots_accounts([t], "favourites", "favourites_count",
+                                        lambda api, home_id: api.status_favourited_by(home_id),
+                                        request_timeout=request_timeout, store=store, sources=sources,
+                                        previous=previous.get("favourites"))
+
+        previous_toot = previous.get("context", {}).get(t["uri"])
+        if is_unchanged(sources[t["uri"]], previous_toot, "replies_count"):
+            context = {
+                "ancestors": previous_toot["ancestors"],
+                "descendants": previous_toot["descendants"],
+                "source": sources[t["uri"]]
+            }
+        else:
+            toot_engine = engine if engine else ContextEngine(request_timeout=request_timeout, store=store)
+            context = toot_engine.get_context(t, source=sources[t["uri"]])
+
+        yield t["uri"], {
+            "reblogs": reblogs[t["uri"]],
+            "favourites": favourites[t["uri"]],
+            "context": context
+        }
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
+
+class InteractionGraph:
+    # accounts and toots are interned to integer ids while the edge rows stream in
+    def __init__(self, weighted=False):
+        self.weighted = weighted
+        self.node_ids = {}
+        self.node_types = array("b")
+        self.kinds = {}
+        self.sources = array("i")
+        self.destinations = array("i")
+        self.edge_kinds = array("b")
+        self.dest_toots = array("i")
+        self.src_toots = array("i")
+        self.weights = Counter()
+
+    def intern(self, name, node_type):
+        node_id = self.node_ids.get(name)
+        if node_id is None:
+            node_id = self.node_ids[name] = len(self.node_ids)
+            self.node_types.append(node_type)
+        return node_id
+
+    def add(self, row):
+        dest_acct, src_acct, kind, dest_uri, src_uri = row
+        source = self.intern(src_acct, 0)
+        destination = self.intern(dest_acct, 0)
+        kind = self.kinds.setdefault(kind, len(self.kinds))
+        if self.weighted:
+            self.weights[(source, destination, kind)] += 1
+            return
+        self.sources.append(source)
+        self.destinations.append(destination)
+        self.edge_kinds.append(kind)
+        self.dest_toots.append(self.intern(dest_uri, 1))
+        self.src_toots.append(self.intern(src_uri, 1) if src_uri else -1)
+
+    def update(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def get_edges(self):
+        if self.weighted:
+            edges = sorted(self.weights.items())
+            return (array("i", [e[0][0] for e in edges]), array("i", [e[0][1] for e in edges]),
+                    array("b", [e[0][2] for e in edges]), array("q", [e[1] for e in edges]))
+        return self.sources, self.destinations, self.edge_kinds, None
+
+    def write(self, dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+        node_types = ["account", "toot"]
+        with open(os.path.join(dir_name, "nodes.csv"), "w") as f:
+            writer = csv.writer(f, dialect="unix")
+            writer.writerow(["id", "type", "name"])
+            for name, node_id in self.node_ids.items():
+                writer.writerow([node_id, node_types[self.node_types[node_id]], name])
+
+        sources, destinations, kinds, weights = self.get_edges()
+        with open(os.path.join(dir_name, "edges.csv"), "w") as f:
+            writer = csv.writer(f, dialect="unix", quoting=csv.QUOTE_MINIMAL)
+            if self.weighted:
+                writer.writerow(["source", "destination", "kind", "weight"])
+                writer.writerows(zip(sources, destinations, kinds, weights))
+            else:
+                writer.writerow(["source", "destination", "kind", "dest_toot", "src_toot"])
+                writer.writerows(zip(sources, destinations, kinds, self.dest_toots, self.src_toots))
+
+        # compressed sparse rows over the source accounts
+        order = sorted(range(len(sources)), key=sources.__getitem__)
+        indptr = array("q", [0] * (len(self.node_ids) + 1))
+        for source in sources:
+            indptr[source + 1] += 1
+        for i in range(len(self.node_ids)):
+            indptr[i + 1] += indptr[i]
+        csr = {
+            "indptr": indptr,
+            "indices": array("i", [destinations[i] for i in order]),
+            "kinds": array("b", [kinds[i] for i in order])
+        }
+        if self.weighted:
+            csr["weights"] = array("q", [weights[i] for i in order])
+        for name, values in csr.items():
+            with open(os.path.join(dir_name, f"csr_{name}.bin"), "wb") as f:
+                values.tofile(f)
+
+        write_json_atomic({
+            "n_nodes": len(self.node_ids),
+            "n_edges": len(sources),
+            "weighted": self.weighted,
+            "kinds": list(self.kinds.keys()),
+            "node_types": node_types,
+            "byteorder": sys.byteorder,
+            "csr": dict([(name, {"file_name": f"csr_{name}.bin", "typecode": values.typecode,
+                                 "itemsize": values.itemsize}) for name, values in csr.items()])
+        }, os.path.join(dir_name, "graph.json"))
+        return len(self.node_ids), len(sources)
+
+
+def iter_account_followers_pages(account_url, max_followers=None, request_timeout=15, limiter=None):
+    # rate limited per host, so several accounts can be crawled in parallel
+    if not limiter:
+        limiter = HostLimiter(max_per_host=1, min_interval=1.5)
     api_base = urlparse(account_url).netloc
-    api = mastodon.Mastodon(
-        api_base_url=api_base, request_timeout=request_timeout, user_agent=USER_AGENT)
+    with limiter(api_base):
+        api = get_api(api_base, request_timeout=request_timeout,
+                      ratelimit_method="wait")
     account_name = account_url.split("@")[-1]
-    account = api.search_v2(f"@{account_name}@{api_base}",
-                            resolve=False, result_type="accounts")["accounts"][0]
+    with limiter(api_base):
+        account = api.search_v2(f"@{account_name}@{api_base}",
+                                resolve=False, result_type="accounts")["accounts"][0]
     if max_followers:
         logger.info(
             f"Getting {max_followers} followers for {account['url']} ({account['followers_count']} followers)")
@@ -781,29 +1704,36 @@ def get_account_followers(account_url, max_followers=None, verbose=False, reques
         logger.info(
             f"Getting all followers for {account['url']} ({account['followers_count']} followers)")
 
-    queried_accounts = []
-    new_followers = api.account_followers(account["id"], limit=40)
-    queried_accounts.extend(add_queried_at(new_followers))
+    with limiter(api_base):
+        new_followers = api.account_followers(account["id"], limit=40)
+    n_followers = len(new_followers)
+    paginate = len(new_followers) >= 40
+    yield add_queried_at(new_followers[:max_followers])
 
-    if len(new_followers) >= 40:
-        paginate = True
-    else:
-        paginate = False
     while paginate:
-        new_followers = api.fetch_next(new_followers)
-        time.sleep(1.5)
+        with limiter(api_base):
+            new_followers = api.fetch_next(new_followers)
         if new_followers:
-            queried_accounts.extend(add_queried_at(new_followers))
-            if len(queried_accounts) < max_followers and len(new_followers) > 0:
+            yield add_queried_at(new_followers[:max(max_followers - n_followers, 0)])
+            n_followers += len(new_followers)
+            if n_followers < max_followers and len(new_followers) > 0:
                 logger.debug(
-                    f"Retrieved {len(new_followers)} new followers and {len(queried_accounts)} followers in total")
+                    f"Retrieved {len(new_followers)} new followers and {n_followers} followers in total")
             else:
                 paginate = False
         else:
             paginate = False
-    if max_followers:
-        queried_accounts = queried_accounts[:max_followers]
-    logger.info(f"Got {len(queried_accounts)} followers for {account['url']}")
+    logger.info(
+        f"Got {min(n_followers, max_followers)} followers for {account['url']}")
+
+
+def get_account_followers(account_url, max_followers=None, verbose=False, request_timeout=15, limiter=None):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    queried_accounts = []
+    for page in iter_account_followers_pages(account_url, max_followers=max_followers, request_timeout=request_timeout, limiter=limiter):
+        queried_accounts.extend(page)
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
@@ -811,7 +1741,159 @@ def get_account_followers(account_url, max_followers=None, verbose=False, reques
     return queried_accounts
 
 
-def get_accounts_by_url(urls, file_name=None, parse_html=False, request_timeout=15, verbose=False):
+class AccountStore:
+    # last seen snapshot of every account, keyed by acct_to_string()
+    # source is the instance a snapshot was fetched from, ids and counts of remote copies differ from the home instance
+    def __init__(self, file_name=ACCOUNT_STORE, max_age=24*60*60):
+        self.file_name = file_name
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS accounts (acct TEXT PRIMARY KEY, first_seen REAL, last_seen REAL, account TEXT, source TEXT)")
+        if "source" not in [c[1] for c in self.db.execute("PRAGMA table_info(accounts)")]:
+            self.db.execute("ALTER TABLE accounts ADD COLUMN source TEXT")
+        self.db.commit()
+
+    def get(self, acct, max_age=None, source=None):
+        if max_age is None:
+            max_age = self.max_age
+        with self.lock:
+            row = self.db.execute(
+                "SELECT last_seen, account, source FROM accounts WHERE acct = ?", (acct,)).fetchone()
+        if source and (not row or row[2] != source):
+            return None
+        if row and (max_age is None or time.time() - row[0] <= max_age):
+            return json.loads(row[1])
+        return None
+
+    def get_home(self, account, max_age=None):
+        # the snapshot fetched from the account's own instance, if there is a fresh one
+        acct = acct_to_string(account)
+        if not acct or "@" not in acct:
+            return None
+        return self.get(acct, max_age=max_age, source=acct.split("@")[-1])
+
+    def put_many(self, accounts, source=None):
+        # a remote copy never replaces a snapshot from the home instance
+        now = time.time()
+        rows = []
+        for account in accounts:
+            acct = acct_to_string(account)
+            if acct:
+                home = acct.split("@")[-1]
+                rows.append((acct, now, now, json.dumps(account, default=str), source, home, home))
+        with self.lock:
+            self.db.executemany(
+                """INSERT INTO accounts VALUES (?, ?, ?, ?, ?) ON CONFLICT(acct) DO UPDATE SET last_seen = excluded.last_seen,
+                   account = excluded.account, source = excluded.source WHERE excluded.source IS ? OR accounts.source IS NOT ?""", rows)
+            self.db.commit()
+        return len(rows)
+
+    def put(self, account, source=None):
+        self.put_many([account], source=source)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class InstanceStore:
+    # last metadata (and peers) of every instance, keyed by domain
+    def __init__(self, file_name=INSTANCE_STORE, max_age=24*60*60):
+        self.file_name = file_name
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS instances (domain TEXT PRIMARY KEY, queried_at REAL, meta TEXT)")
+        self.db.commit()
+
+    def get(self, domain, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+        with self.lock:
+            row = self.db.execute(
+                "SELECT queried_at, meta FROM instances WHERE domain = ?", (domain,)).fetchone()
+        if row and (max_age is None or time.time() - row[0] <= max_age):
+            return json.loads(row[1])
+        return None
+
+    def put(self, domain, meta):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, ?)",
+                            (domain, time.time(), json.dumps(meta, default=str)))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StatusStore:
+    # resolved statuses, reachable by every url or uri they were requested or known by
+    def __init__(self, file_name=STATUS_STORE):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS toots (uri TEXT PRIMARY KEY, queried_at REAL, toot TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, uri TEXT)")
+        self.db.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT toot FROM urls JOIN toots ON toots.uri = urls.uri WHERE url = ?", (url,)).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def put_many(self, toots):
+        # toots are (requested url, status) pairs
+        now = time.time()
+        with self.lock:
+            for url, toot in toots:
+                self.db.execute("INSERT OR REPLACE INTO toots VALUES (?, ?, ?)",
+                                (toot["uri"], now, json.dumps(toot, default=str)))
+                self.db.executemany("INSERT OR REPLACE INTO urls VALUES (?, ?)",
+                                    [(u, toot["uri"]) for u in set([url, toot["uri"], toot["url"]]) if u])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def lookup_account(api, account_name, api_base):
+    # exact lookup on the home instance, search is slow and heavily throttled. Servers
+    # older than Mastodon 3.4 and other implementations fail the version check instead
+    try:
+        return api.account_lookup(account_name)
+    except (mastodon.MastodonAPIError, mastodon.MastodonVersionError):
+        return api.search_v2(f"@{account_name}@{api_base}", resolve=False, result_type="accounts")["accounts"][0]
+
+
+def get_accounts_by_url(urls, file_name=None, parse_html=False, request_timeout=15, max_workers=8, store=None, verbose=False):
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
@@ -819,25 +1901,61 @@ def get_accounts_by_url(urls, file_name=None, parse_html=False, request_timeout=
         logger.warning(f"No account urls supplied, exiting.")
         exit()
 
-    accounts = []
-    for i, url in enumerate(urls):
-        try:
-            api_base = urlparse(url).netloc
-            api = mastodon.Mastodon(
-                api_base_url=api_base, request_timeout=request_timeout, user_agent=USER_AGENT)
+    hosts = {}
+    for url in urls:
+        hosts.setdefault(urlparse(url).netloc, []).append(url)
+
+    found_accounts = {}
+    lock = threading.Lock()
+
+    def lookup_host(api_base, host_urls):
+        api = None
+        for url in host_urls:
             account_name = url.split("@")[-1]
-            account = api.search_v2(
-                f"@{account_name}@{api_base}", resolve=False, result_type="accounts")["accounts"][0]
-            accounts.append(account)
+            acct = f"{account_name}@{api_base}"
+            with lock:
+                account = account_cache.get(acct)
+            if not account and store:
+                # only snapshots from the home instance, copies on other instances have their own ids
+                account = store.get(acct, source=api_base)
+            if not account:
+                try:
+                    if not api:
+                        api = get_api(api_base, request_timeout=request_timeout,
+                                      ratelimit_method="wait")
+                    account = lookup_account(api, account_name, api_base)
+                except Exception as e:
+                    logger.error(f"Error retrieving info for {url}: {e}")
+                    continue
+                account["queried_at"] = datetime.now()
+                if store:
+                    store.put(account, source=api_base)
+            with lock:
+                account_cache[acct] = account
             logger.info(
                 f"Retrieved info for @{account['acct']} \"{account['display_name']}\" ({account['followers_count']} follower, {account['statuses_count']} posts)")
-            if verbose:
-                message = f"Retrieved info for account {i+1} of {len(urls)}: @{account['acct']} ({account['followers_count']} follower, {account['statuses_count']} posts)"
-                print(f'{message:{get_terminal_size().columns}.{get_terminal_size().columns}}', end="\r")
-        except:
-            logger.error(f"Error retrieving info for {url}")
-
-    accounts = add_queried_at(accounts)
+            with lock:
+                found_accounts[url] = account
+                if verbose:
+                    message = f"Retrieved info for account {len(found_accounts)} of {len(urls)}: @{account['acct']} ({account['followers_count']} follower, {account['statuses_count']} posts)"
+                    print(f'{message:{get_terminal_size().columns}.{get_terminal_size().columns}}', end="\r")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict([(executor.submit(lookup_host, api_base, host_urls), api_base)
+                        for api_base, host_urls in hosts.items()])
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Could not get accounts from {futures[future]}: {e}")
+
+    # one copy per account, in the order of the supplied urls
+    accounts = {}
+    for url in urls:
+        if url in found_accounts:
+            account = found_accounts[url]
+            accounts.setdefault(acct_to_string(account), account.copy())
+    accounts = list(accounts.values())
     if file_name and ".csv" in file_name:
         with open(file_name, "w") as f:
             writer = csv.writer(f, dialect="unix")
@@ -849,18 +1967,101 @@ def get_accounts_by_url(urls, file_name=None, parse_html=False, request_timeout=
     return accounts
 
 
+def iter_account_statuses_pages(api, account_id, since_id=None, max_posts=None):
+    # newest first, the next links of the server drop since_id, so the cursor is checked here
+    n_posts = 0
+    for page in iter_pages(api, api.account_statuses(account_id, since_id=since_id, limit=40)):
+        reached_cursor = since_id is not None and any([t["id"] <= since_id for t in page])
+        if since_id is not None:
+            page = [t for t in page if t["id"] > since_id]
+        if max_posts:
+            page = page[:max_posts - n_posts]
+        n_posts += len(page)
+        if page:
+            yield add_queried_at(page)
+        if reached_cursor or (max_posts and n_posts >= max_posts):
+            return
+
+
+def get_accounts_posts(accounts, sink, cursors=None, max_posts=None, request_timeout=15, max_workers=8, verbose=False):
+    # cursors maps acct_to_string() to the account's id on its home instance and the newest post id already
+    # in the sink ({"account_id": ..., "since_id": ...}), and is updated in place
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    if cursors is None:
+        cursors = {}
+
+    hosts = {}
+    for account in accounts:
+        hosts.setdefault(urlparse(account["url"]).netloc, []).append(account)
+
+    lock = threading.Lock()
+    n_posts = Counter()
+
+    def crawl_host(api_base, host_accounts):
+        api = get_api(api_base, request_timeout=request_timeout, ratelimit_method="wait")
+        for account in host_accounts:
+            acct = acct_to_string(account)
+            cursor = cursors.get(acct)
+            if cursor is not None and not isinstance(cursor, dict):
+                cursor = {"account_id": None, "since_id": cursor}
+            # the id of a stored account can be the one of a remote copy, posts are paged by the home id
+            if cursor and cursor["account_id"]:
+                account_id = cursor["account_id"]
+            else:
+                try:
+                    account_id = lookup_account(api, account["username"], api_base)["id"]
+                except Exception as e:
+                    logger.error(f"Error looking up {acct} on {api_base}: {e}")
+                    continue
+            since_id = cursor["since_id"] if cursor and cursor["account_id"] in [None, account_id] else None
+            newest_id = since_id
+            try:
+                for page in iter_account_statuses_pages(api, account_id, since_id=since_id, max_posts=max_posts):
+                    # ids of Pleroma and Akkoma are strings, they are never compared with 0
+                    newest_id = max([t["id"] for t in page] + ([newest_id] if newest_id is not None else []))
+                    with lock:
+                        sink.write(page, instance_name=api_base)
+                        n_posts[acct] += len(page)
+            except Exception as e:
+                logger.error(f"Error retrieving posts of {acct}: {e}")
+                continue
+            with lock:
+                if newest_id is not None:
+                    cursors[acct] = {"account_id": account_id, "since_id": newest_id}
+            logger.info(f"Retrieved {n_posts[acct]} new posts of {acct}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict([(executor.submit(crawl_host, api_base, host_accounts), api_base)
+                        for api_base, host_accounts in hosts.items()])
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Could not get posts from {futures[future]}: {e}")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
+    return n_posts
+
+
 def get_instance_trends(api_base, access_token=None, verbose=False, request_timeout=30):
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
     try:
-        api = mastodon.Mastodon(api_base_url=api_base, access_token=access_token,
-                                request_timeout=request_timeout, ratelimit_method="pace", user_agent=USER_AGENT)
-        trends = {
-            "tags": api.trending_tags(),
-            "statuses": add_queried_at(api.trending_statuses()),
-            "links": api.trending_links()
-        }
+        api = get_api(api_base, access_token=access_token, request_timeout=request_timeout)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            tags = executor.submit(api.trending_tags)
+            statuses = executor.submit(api.trending_statuses)
+            links = executor.submit(api.trending_links)
+            trends = {
+                "tags": tags.result(),
+                "statuses": add_queried_at(statuses.result()),
+                "links": links.result()
+            }
         logger.info(f"Got trends for {api_base}")
     except:
         trends = None
@@ -873,37 +2074,183 @@ def get_instance_trends(api_base, access_token=None, verbose=False, request_time
     return trends
 
 
-def get_instances_by_url(urls, file_name=None, include_peers=False, parse_html=False, request_timeout=15, verbose=False):
+def get_trends(instances, max_workers=8, request_timeout=30, verbose=False):
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
-    if not urls:
-        logger.warning(f"No instance urls supplied, exiting.")
-        exit()
+    trends = dict([(api_base, None) for api_base in instances])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for api_base in health.rank(instances):
+            if not health.is_available(api_base):
+                logger.warning(f"Skipping {api_base} after repeated failures")
+                continue
+            if api_base in access_tokens.keys():
+                access_token = access_tokens[api_base]
+            else:
+                access_token = None
+            futures[executor.submit(get_instance_trends, api_base, access_token=access_token,
+                                    request_timeout=request_timeout)] = api_base
+        for future in as_completed(futures):
+            trends[futures[future]] = future.result()
 
-    instances = {}
-    for api_base in urls:
-        if api_base in access_tokens.keys():
-            access_token = access_tokens[api_base]
-        else:
-            access_token = None
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
+    return trends
+
+
+# entries are identified by their key, the volatile fields change between polls
+trends_id_keys = {"tags": "name", "links": "url", "statuses": "uri"}
+trends_volatile_keys = {
+    "tags": ["history"],
+    "links": ["history"],
+    "statuses": ["replies_count", "reblogs_count", "favourites_count"]
+}
+
+
+def diff_trends(old, new):
+    diff = {}
+    for kind, id_key in trends_id_keys.items():
+        volatile_keys = trends_volatile_keys[kind]
+        old_entries = dict([(entry[id_key], entry) for entry in old[kind]])
+        added = []
+        updated = []
+        for entry in new[kind]:
+            old_entry = old_entries.get(entry[id_key])
+            if old_entry is None:
+                added.append(entry)
+            elif kind != "statuses" and any([entry[k] != old_entry.get(k) for k in entry.keys() if k not in volatile_keys]):
+                added.append(entry)
+            elif any([entry.get(k) != old_entry.get(k) for k in volatile_keys]):
+                updated.append(dict([(k, entry[k]) for k in [id_key, "queried_at"] + volatile_keys if k in entry]))
+        new_ids = [entry[id_key] for entry in new[kind]]
+        diff[kind] = {
+            "added": added,
+            "updated": updated,
+            "removed": [i for i in old_entries.keys() if i not in set(new_ids)]
+        }
+        if new_ids != list(old_entries.keys()):
+            diff[kind]["order"] = new_ids
+    return diff
+
+
+def apply_trends_diff(old, diff):
+    new = {}
+    for kind, id_key in trends_id_keys.items():
+        entries = dict([(entry[id_key], entry) for entry in old[kind]])
+        for entry in diff[kind]["added"]:
+            entries[entry[id_key]] = entry
+        for entry in diff[kind]["updated"]:
+            entries[entry[id_key]] = {**entries[entry[id_key]], **entry}
+        for i in diff[kind]["removed"]:
+            entries.pop(i, None)
+        order = diff[kind].get("order", [entry[id_key] for entry in old[kind] if entry[id_key] in entries])
+        new[kind] = [entries[i] for i in order]
+    return new
+
+
+def is_empty_trends_diff(diff):
+    return not any([diff[kind]["added"] or diff[kind]["updated"] or diff[kind]["removed"] or "order" in diff[kind]
+                    for kind in trends_id_keys.keys()])
+
+
+def iter_trends_snapshots(files):
+    # snapshots in time order, diffs are applied to the last snapshot of their instance
+    def timestamp(file_name):
+        prefix = os.path.basename(file_name).split("_")[0]
+        return int(prefix) if prefix.isdigit() else 0
+
+    state = {}
+    for file_name in sorted(files, key=timestamp):
+        with open(file_name, "r") as f:
+            snapshots = json.load(f)
+        for instance, trends in snapshots.items():
+            if not trends:
+                continue
+            if file_name.endswith("_trends_diff.json"):
+                if instance not in state:
+                    logger.warning(f"No snapshot of {instance} before {file_name}, skipping")
+                    continue
+                trends = apply_trends_diff(state[instance], trends)
+            state[instance] = trends
+            yield instance, trends
 
-        try:
-            api = mastodon.Mastodon(api_base_url=api_base, request_timeout=request_timeout, access_token=access_token, user_agent=USER_AGENT)
-            instance = api.instance()
-        except:
-            instance = None
 
+def get_instance_meta(api_base, include_peers=False, request_timeout=15):
+    if api_base in access_tokens.keys():
+        access_token = access_tokens[api_base]
+    else:
+        access_token = None
+
+    try:
+        api = get_api(api_base, access_token=access_token, request_timeout=request_timeout, ratelimit_method="wait")
+        instance = api.instance()
+    except:
+        return {"instance": None, "activity": None, "queried_at": datetime.now()}
+
+    try:
+        activity = api.instance_activity()
+    except:
+        activity = None
+
+    meta = {"instance": instance, "activity": activity, "queried_at": datetime.now()}
+    if include_peers:
         try:
-            activity = api.instance_activity()
+            meta["peers"] = api.instance_peers()
         except:
-            activity = None
+            meta["peers"] = []
+    return meta
 
-        instances[api_base] = {"instance": instance,
-                               "activity": activity, "queried_at": datetime.now()}
-        if instance:
-            logger.info(
-                f"Retrieved info for {api_base} ({instance['stats']['user_count']} users and {instance['stats']['status_count']} posts)")
+
+def get_instances_by_url(urls, file_name=None, include_peers=False, max_depth=1, max_instances=500, parse_html=False,
+                         request_timeout=15, max_workers=8, store=None, verbose=False):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    if not urls:
+        logger.warning(f"No instance urls supplied, exiting.")
+        exit()
+
+    def get_meta(api_base):
+        meta = store.get(api_base) if store else None
+        if meta is None or (include_peers and "peers" not in meta):
+            meta = get_instance_meta(api_base, include_peers=include_peers, request_timeout=request_timeout)
+            if store and meta["instance"]:
+                store.put(api_base, meta)
+        return meta
+
+    # breadth first over the peers, every domain is queried at most once
+    instances = {}
+    visited = set(urls)
+    frontier = list(dict.fromkeys(urls))
+    depth = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while frontier:
+            peers = {}
+            instances.update([(api_base, None) for api_base in frontier])
+            futures = dict([(executor.submit(get_meta, api_base), api_base) for api_base in frontier])
+            for future in as_completed(futures):
+                api_base = futures[future]
+                instances[api_base] = future.result()
+                instance = instances[api_base]["instance"]
+                if instance:
+                    logger.info(
+                        f"Retrieved info for {api_base} ({instance['stats']['user_count']} users and {instance['stats']['status_count']} posts)")
+                peers[api_base] = instances[api_base].pop("peers", None) or []
+
+            peers = [peer for api_base in frontier for peer in peers[api_base]]
+            frontier = []
+            if include_peers and depth < max_depth:
+                for peer in peers:
+                    if max_instances and len(visited) >= max_instances:
+                        break
+                    if peer not in visited:
+                        visited.add(peer)
+                        frontier.append(peer)
+                depth += 1
+                if frontier:
+                    logger.info(f"Found {len(frontier)} new peers at depth {depth}")
 
     if file_name and ".csv" in file_name:
         with open(file_name, "w") as f:
@@ -913,24 +2260,278 @@ def get_instances_by_url(urls, file_name=None, include_peers=False, parse_html=F
                 writer.writerow(instance)
 
     logger.info(f"Retrieved {len(instances)} instances")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
     return instances
 
 
-def get_toots_by_url(urls, verbose=False):
-    pass
+def get_toots_by_url(urls, sink=None, store=None, request_timeout=15, max_workers=16, max_per_host=4, verbose=False):
+    # statuses by their url or uri, hosts are resolved concurrently in up to
+    # max_per_host chunks each, results are written to the sink (or returned) page by page.
+    # urls without a status id can only be resolved by a search with a token, without
+    # one they are returned as unsupported instead of spending a throttled search each
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
 
+    hosts = {}
+    for url in dict.fromkeys(urls):
+        hosts.setdefault(urlparse(url).netloc, []).append(url)
+
+    lock = threading.Lock()
+    toots = []
+    failed = []
+    unsupported = []
+    n_toots = Counter()
+
+    def write(page, api_base):
+        with lock:
+            if sink:
+                sink.write(page, instance_name=api_base)
+            else:
+                toots.extend(page)
+            n_toots[api_base] += len(page)
+
+    def resolve_chunk(api_base, chunk):
+        api = None
+        page = []
+        resolved = []
+        for url in chunk:
+            toot = store.get(url) if store else None
+            if toot is None:
+                access_token = access_tokens.get(api_base)
+                has_id = re.search(r"/\d+$", url)
+                if not has_id and not access_token:
+                    with lock:
+                        unsupported.append(url)
+                    continue
+                try:
+                    if not api:
+                        api = get_api(api_base, access_token=access_token,
+                                      request_timeout=request_timeout, ratelimit_method="wait")
+                    if has_id:
+                        toot = api.status(get_home_id({"uri": url}))
+                    else:
+                        # urls are only looked up with resolve, which needs a token
+                        toot = api.search_v2(url, resolve=True, result_type="statuses")["statuses"][0]
+                except Exception as e:
+                    logger.warning(f"Could not resolve {url}: {e}")
+                    with lock:
+                        failed.append(url)
+                    continue
+                toot["queried_at"] = datetime.now()
+                resolved.append((url, toot))
+            page.append(toot)
+            if len(page) >= 40:
+                if store:
+                    store.put_many(resolved)
+                write(page, api_base)
+                page = []
+                resolved = []
+        if store and resolved:
+            store.put_many(resolved)
+        if page:
+            write(page, api_base)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for api_base, host_urls in hosts.items():
+            n_chunks = min(max_per_host, len(host_urls))
+            for i in range(n_chunks):
+                futures[executor.submit(resolve_chunk, api_base, host_urls[i::n_chunks])] = api_base
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Could not resolve toots from {futures[future]}: {e}")
+            if verbose:
+                message = f"Resolved {sum(n_toots.values())} of {len(urls)} toots ({len(failed)} failed)"
+                print(f'{message: <70}', end="\r")
+
+    logger.info(f"Resolved {sum(n_toots.values())} toots from {len(hosts)} instances")
 
-def search_public(api_base, query=None, access_token=None, min_id=None, max_id=None, max_toots=None, local_only=False, verbose=False, request_timeout=30):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
+    return toots, failed, unsupported
+
+
+media_key_names = ["toot_uri", "instance_name", "media_id", "type", "source_url", "sha256", "file_name", "size", "content_type"]
+
+
+class MediaStore:
+    # manifest of a media directory: downloaded files by source url, and which toots use them
+    def __init__(self, dir_name):
+        self.dir_name = dir_name
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(dir_name, "manifest.db"), check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS media (source_url TEXT PRIMARY KEY, sha256 TEXT, file_name TEXT,
+                           size INTEGER, content_type TEXT, downloaded_at REAL, error TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS toot_media (toot_uri TEXT, instance_name TEXT, media_id TEXT, type TEXT,
+                           source_url TEXT, PRIMARY KEY (toot_uri, source_url))""")
+        self.db.commit()
+
+    def add_toot(self, toot, instance_name=None):
+        # the origin url is the same on every instance, the local copy is a fallback
+        sources = {}
+        with self.lock:
+            for media in toot.get("media_attachments") or []:
+                urls = [u for u in [media.get("remote_url"), media.get("url")] if u]
+                if not urls:
+                    continue
+                self.db.execute("INSERT OR IGNORE INTO toot_media VALUES (?, ?, ?, ?, ?)",
+                                (toot["uri"], instance_name, str(media["id"]), media["type"], urls[0]))
+                sources[urls[0]] = urls
+        return sources
+
+    def is_downloaded(self, source_url):
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM media WHERE source_url = ?", (source_url,)).fetchone()
+        return bool(row and row[0])
+
+    def put(self, source_url, sha256=None, file_name=None, size=None, content_type=None, error=None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (source_url, sha256, file_name, size, content_type, time.time(), error))
+            self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def iter_manifest(self):
+        with self.lock:
+            rows = self.db.execute("""
+                SELECT toot_uri, instance_name, media_id, type, toot_media.source_url, sha256, file_name, size, content_type
+                FROM toot_media LEFT JOIN media ON media.source_url = toot_media.source_url
+                ORDER BY toot_uri""").fetchall()
+        for row in rows:
+            yield list(row)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def download_file(session, url, dir_name, request_timeout=30):
+    # stored under its sha256, so identical files from different urls are kept once
+    tmp_dir = os.path.join(dir_name, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_name = os.path.join(tmp_dir, hashlib.sha256(url.encode()).hexdigest())
+    digest = hashlib.sha256()
+    size = 0
+    with session.get(url, stream=True, timeout=request_timeout, headers={"User-Agent": USER_AGENT}) as r:
+        r.raise_for_status()
+        content_type = r.headers.get("Content-Type")
+        with open(tmp_name, "wb") as f:
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    sha256 = digest.hexdigest()
+    extension = os.path.splitext(urlparse(url).path)[1][:8].lower()
+    file_name = os.path.join(sha256[:2], f"{sha256}{extension}")
+    os.makedirs(os.path.join(dir_name, sha256[:2]), exist_ok=True)
+    if os.path.exists(os.path.join(dir_name, file_name)):
+        os.remove(tmp_name)
+    else:
+        os.replace(tmp_name, os.path.join(dir_name, file_name))
+    return sha256, file_name, size, content_type
+
+
+def download_media(toots, dir_name, max_workers=16, max_per_host=4, request_timeout=30, verbose=False):
+    # toots are (instance_name, toot) pairs, media already in the manifest is skipped
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
 
+    os.makedirs(dir_name, exist_ok=True)
+    # files of an interrupted run are incomplete
+    shutil.rmtree(os.path.join(dir_name, "tmp"), ignore_errors=True)
+    store = MediaStore(dir_name)
+
+    sources = {}
+    n_toots = 0
+    for instance_name, toot in toots:
+        sources.update(store.add_toot(toot, instance_name=instance_name))
+        n_toots += 1
+    store.commit()
+    pending = [(source_url, urls) for source_url, urls in sources.items() if not store.is_downloaded(source_url)]
+    logger.info(f"{len(sources)} media files in {n_toots} toots, {len(pending)} to download")
+
+    limiter = HostLimiter(max_per_host=max_per_host)
+    sessions = threading.local()
+    n_files = Counter()
+
+    def download(source_url, urls):
+        if not hasattr(sessions, "session"):
+            sessions.session = HealthSession(health)
+        error = None
+        for url in urls:
+            try:
+                with limiter(get_host(url)):
+                    sha256, file_name, size, content_type = download_file(
+                        sessions.session, url, dir_name, request_timeout=request_timeout)
+                store.put(source_url, sha256=sha256, file_name=file_name, size=size, content_type=content_type)
+                return True
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        store.put(source_url, error=error)
+        logger.warning(f"Could not download {source_url}: {error}")
+        return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download, source_url, urls) for source_url, urls in pending]
+        for future in as_completed(futures):
+            n_files["downloaded" if future.result() else "failed"] += 1
+            if verbose:
+                message = f"Downloaded {n_files['downloaded']} of {len(pending)} media files ({n_files['failed']} failed)"
+                print(f'{message: <70}', end="\r")
+
+    shutil.rmtree(os.path.join(dir_name, "tmp"), ignore_errors=True)
+    with open(os.path.join(dir_name, "manifest.csv"), "w") as f:
+        writer = csv.writer(f, dialect="unix")
+        writer.writerow(media_key_names)
+        writer.writerows(store.iter_manifest())
+    store.close()
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
+    return {"n_toots": n_toots, "n_media": len(sources), "downloaded": n_files["downloaded"], "failed": n_files["failed"]}
+
+
+def iter_pages(api, page, previous=False):
+    while page:
+        yield page
+        if previous:
+            page = api.fetch_previous(page)
+        else:
+            page = api.fetch_next(page)
+
+
+def write_pages(pages, sink, instance_name=None):
+    n_items = 0
+    for page in pages:
+        sink.write(page, instance_name=instance_name)
+        n_items += len(page)
+    return n_items
+
+
+def iter_public_pages(api_base, access_token=None, min_id=None, max_id=None, max_toots=None, local_only=False, request_timeout=30):
     try:
-        api = mastodon.Mastodon(api_base_url=api_base, access_token=access_token,
-                            request_timeout=request_timeout, ratelimit_method="pace", user_agent=USER_AGENT)
+        api = get_api(api_base, access_token=access_token,
+                      request_timeout=request_timeout)
     except:
         logger.warning(
             f"There was a problem connecting to {api_base}")
-        return None
+        return
 
     if min_id and (not isinstance(min_id, datetime)):
         min_id = int(min_id)
@@ -938,7 +2539,6 @@ def search_public(api_base, query=None, access_token=None, min_id=None, max_id=N
     if max_id and (not isinstance(max_id, datetime)):
         max_id = int(max_id)
 
-    queried_toots = []
     try:
         if min_id and not max_id:
             new_toots = api.timeline_public(
@@ -946,48 +2546,60 @@ def search_public(api_base, query=None, access_token=None, min_id=None, max_id=N
         elif max_id and not min_id:
             new_toots = api.timeline_public(
                 limit=40, max_id=max_id, local=local_only)
-        queried_toots.extend(add_queried_at(new_toots))
+        else:
+            new_toots = api.timeline_public(limit=40, local=local_only)
     except mastodon.MastodonAPIError as e:
         logger.warning(
             f"There was a problem connecting to {api_base}: {e.args[1:]}")
-        return None
+        return
 
-    if len(queried_toots) == 0:
-        logger.info(f"No toots with that hashtag found")
+    if len(new_toots) == 0:
+        logger.info(f"No toots found on {api_base}")
+        return
+    n_toots = len(new_toots)
+    yield add_queried_at(new_toots)
 
-        if verbose and logger.level >= 20:
-            logger.setLevel(logging.WARNING)
-        return None
-
-    if len(new_toots) >= 40 and len(queried_toots) < max_toots:
-        paginate = True
-    else:
-        paginate = False
+    paginate = len(new_toots) >= 40 and (not max_toots or n_toots < max_toots)
     while paginate:
         try:
             new_toots = api.fetch_previous(new_toots)
         except:
             new_toots = []
-        if len(new_toots) > 0 and len(queried_toots) < max_toots:
-            queried_toots.extend(add_queried_at(new_toots))
+        if new_toots and len(new_toots) > 0 and (not max_toots or n_toots < max_toots):
+            n_toots += len(new_toots)
             logger.info(
-                f"Got {len(queried_toots)} toots from {api_base} ({api.ratelimit_remaining} calls remaining, reset at {datetime.fromtimestamp(api.ratelimit_reset):%Y-%m-%d %H:%M:%S})")
+                f"Got {n_toots} toots from {api_base} ({api.ratelimit_remaining} calls remaining, reset at {datetime.fromtimestamp(api.ratelimit_reset):%Y-%m-%d %H:%M:%S})")
+            yield add_queried_at(new_toots)
         else:
             paginate = False
 
     logger.handlers[0].flush()
+
+
+def search_public(api_base, query=None, access_token=None, min_id=None, max_id=None, max_toots=None, local_only=False, verbose=False, request_timeout=30):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    queried_toots = []
+    for page in iter_public_pages(api_base, access_token=access_token, min_id=min_id, max_id=max_id, max_toots=max_toots, local_only=local_only, request_timeout=request_timeout):
+        queried_toots.extend(page)
+
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
 
+    if len(queried_toots) == 0:
+        return None
     return queried_toots
 
 
-def search_hashtag(queried_hashtag, api_base, access_token=None, min_id=None, max_id=None, local_only=False, verbose=False, request_timeout=30):
-    if verbose and logger.level >= 20:
-        logger.setLevel(logging.INFO)
-
-    api = mastodon.Mastodon(api_base_url=api_base, access_token=access_token,
-                            request_timeout=request_timeout, ratelimit_method="pace", user_agent=USER_AGENT)
+def iter_hashtag_pages(queried_hashtag, api_base, access_token=None, min_id=None, max_id=None, local_only=False, request_timeout=30):
+    try:
+        api = get_api(api_base, access_token=access_token,
+                      request_timeout=request_timeout)
+    except:
+        logger.warning(
+            f"There was a problem connecting to {api_base}")
+        return
 
     if queried_hashtag[0] == "#":
         logger.warning(f"Leading '#' was removed from queried hashtag.")
@@ -996,55 +2608,318 @@ def search_hashtag(queried_hashtag, api_base, access_token=None, min_id=None, ma
     if (not isinstance(min_id, datetime)):
         min_id = int(min_id)
 
-    queried_toots = []
     try:
         new_toots = api.timeline_hashtag(
             hashtag=queried_hashtag, limit=40, local=local_only, min_id=min_id)
-        queried_toots.extend(add_queried_at(new_toots))
     except mastodon.MastodonAPIError as e:
         logger.warning(
             f"There was a problem connecting to {api_base}: {e.args[1:]}")
-        return queried_toots
+        return
     except mastodon.MastodonNetworkError as e:
         logger.warning(
             f"There was a problem connecting to {api_base}: {e.args[1:]}")
-        return queried_toots
+        return
     except ConnectTimeout:
         logger.warning(
             f"There was a problem connecting to {api_base}: ConnectTimeout")
-        return queried_toots
+        return
 
-    if len(queried_toots) == 0:
+    if len(new_toots) == 0:
         logger.info(f"No toots with that hashtag found")
-        if verbose and logger.level >= 20:
-            logger.setLevel(logging.WARNING)
-        return None
+        return
+    n_toots = len(new_toots)
+    yield add_queried_at(new_toots)
 
-    if len(new_toots) >= 40:  # check if this makes sense
-        paginate = True
-    else:
-        paginate = False
+    paginate = len(new_toots) >= 40  # check if this makes sense
     while paginate:
         try:
             new_toots = api.fetch_previous(new_toots)
-            if len(new_toots) > 0:
-                queried_toots.extend(add_queried_at(new_toots))
-                logger.info(
-                    f"Got {len(queried_toots)} toots from {api_base} ({api.ratelimit_remaining} calls remaining, reset at {datetime.fromtimestamp(api.ratelimit_reset):%Y-%m-%d %H:%M:%S})")
-                if max_id and any([t["id"] > max_id for t in new_toots]):
-                    paginate = False
-            else:
-                paginate = False
         except:
-            return queried_toots
+            return
+        if new_toots and len(new_toots) > 0:
+            n_toots += len(new_toots)
+            logger.info(
+                f"Got {n_toots} toots from {api_base} ({api.ratelimit_remaining} calls remaining, reset at {datetime.fromtimestamp(api.ratelimit_reset):%Y-%m-%d %H:%M:%S})")
+            yield add_queried_at(new_toots)
+            if max_id and any([t["id"] > max_id for t in new_toots]):
+                paginate = False
+        else:
+            paginate = False
 
     logger.handlers[0].flush()
+
+
+# Mastodon only uses the first four any[] tags of a hashtag timeline request
+MAX_ANY_TAGS = 4
+
+
+def batch_tags(hashtags):
+    size = MAX_ANY_TAGS + 1
+    return [hashtags[i:i + size] for i in range(0, len(hashtags), size)]
+
+
+def add_tracked_tags(toots, hashtags):
+    hashtags = set(hashtags)
+    for toot in toots:
+        toot["tracked_tags"] = [tag["name"].lower() for tag in toot["tags"] if tag["name"].lower() in hashtags]
+    return toots
+
+
+def iter_tags_pages(hashtags, api_base, access_token=None, min_id=None, max_id=None, local_only=False, request_timeout=30):
+    # toots with any of the hashtags, oldest page first. The pagination links of
+    # the server drop any[], so pages are requested with explicit min_ids
+    try:
+        api = get_api(api_base, access_token=access_token,
+                      request_timeout=request_timeout)
+    except:
+        logger.warning(
+            f"There was a problem connecting to {api_base}")
+        return
+
+    timeline = f"tag/{quote(hashtags[0])}"
+    if len(hashtags) > 1:
+        timeline += "?" + urlencode([("any[]", tag) for tag in hashtags[1:]])
+
+    n_toots = 0
+    while True:
+        try:
+            new_toots = api.timeline(timeline, local=local_only, min_id=min_id, limit=40)
+        except (mastodon.MastodonAPIError, mastodon.MastodonNetworkError) as e:
+            logger.warning(
+                f"There was a problem connecting to {api_base}: {e.args[1:]}")
+            return
+        if not new_toots:
+            return
+        min_id = max([t["id"] for t in new_toots])
+        if max_id:
+            new_toots = [t for t in new_toots if t["id"] <= max_id]
+        n_toots += len(new_toots)
+        logger.info(
+            f"Got {n_toots} toots with {len(hashtags)} hashtags from {api_base}")
+        if new_toots:
+            yield add_queried_at(new_toots)
+        if len(new_toots) < 40:
+            return
+
+
+def search_hashtag(queried_hashtag, api_base, access_token=None, min_id=None, max_id=None, local_only=False, verbose=False, request_timeout=30):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    queried_toots = []
+    for page in iter_hashtag_pages(queried_hashtag, api_base, access_token=access_token, min_id=min_id, max_id=max_id, local_only=local_only, request_timeout=request_timeout):
+        queried_toots.extend(page)
+
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
 
+    if len(queried_toots) == 0:
+        return None
     return queried_toots
 
 
+def iter_id_range(api, min_id, max_id, hashtag=None, local_only=False, limiter=None, api_base=None):
+    # walk backwards from max_id (exclusive) down to min_id (inclusive)
+    while True:
+        with limiter(api_base) if limiter else nullcontext():
+            if hashtag:
+                page = api.timeline_hashtag(
+                    hashtag, local=local_only, max_id=max_id, since_id=min_id - 1, limit=40)
+            else:
+                page = api.timeline_public(
+                    local=local_only, max_id=max_id, since_id=min_id - 1, limit=40)
+        page = [t for t in page if t["id"] >= min_id]
+        if not page:
+            return
+        max_id = min([t["id"] for t in page])
+        yield add_queried_at(page), max_id
+
+
+def backfill_timelines(data_dir, instances=None, start_date=None, end_date=None, hashtag=None, filter_query=None, local_only=False, n_shards=8, max_workers=8, max_per_host=2, request_timeout=30, verbose=False):
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.INFO)
+
+    shard_dir = f"{data_dir}/backfill"
+    state_file = f"{shard_dir}/state.json"
+    if os.path.isfile(state_file):
+        with open(state_file, "r") as f:
+            state = json.load(f)
+        logger.info(f"Resuming backfill from {state_file}")
+    else:
+        os.makedirs(shard_dir, exist_ok=True)
+        shards = {}
+        # interleave instances so that workers are not all waiting on one host
+        for min_id, max_id in get_id_shards(start_date, end_date, n_shards):
+            for instance in instances:
+                shards[f"{instance}/{min_id}"] = {"instance": instance, "min_id": min_id,
+                                                  "max_id": max_id, "cursor": max_id, "offset": 0, "done": False}
+        state = {
+            "hashtag": hashtag,
+            "filter_query": filter_query,
+            "instances": instances,
+            "local_only": local_only,
+            "start_date": snowflake_from_datetime(start_date),
+            "end_date": snowflake_from_datetime(end_date),
+            "shards": shards
+        }
+        write_json_atomic(state, state_file)
+
+    state_lock = threading.Lock()
+    limiter = HostLimiter(max_per_host=max_per_host)
+
+    def run_shard(key):
+        shard = state["shards"][key]
+        api_base = shard["instance"]
+        if api_base in access_tokens.keys():
+            access_token = access_tokens[api_base]
+        else:
+            access_token = None
+        with limiter(api_base):
+            api = get_api(api_base, access_token=access_token,
+                          request_timeout=request_timeout)
+        n_toots = 0
+        with open(f"{shard_dir}/{api_base}_{shard['min_id']}.jsonl", "a") as f:
+            # drop anything written after the last checkpoint
+            f.truncate(shard["offset"])
+            for page, cursor in iter_id_range(api, shard["min_id"], shard["cursor"], hashtag=state["hashtag"], local_only=state["local_only"], limiter=limiter, api_base=api_base):
+                page = filter_toots(page, query=state["filter_query"])
+                for toot in page:
+                    f.write(json.dumps(toot, default=str))
+                    f.write("\n")
+                f.flush()
+                os.fsync(f.fileno())
+                n_toots += len(page)
+                with state_lock:
+                    shard["cursor"] = cursor
+                    shard["offset"] = f.tell()
+                    write_json_atomic(state, state_file)
+        with state_lock:
+            shard["done"] = True
+            write_json_atomic(state, state_file)
+        return n_toots
+
+    pending = [k for k, shard in state["shards"].items() if not shard["done"]]
+    logger.info(
+        f"Backfilling {len(pending)} of {len(state['shards'])} shards with {max_workers} workers")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict([(executor.submit(run_shard, k), k) for k in pending])
+        for n, future in enumerate(as_completed(futures), start=1):
+            try:
+                logger.info(
+                    f"{n}/{len(pending)}: Got {future.result()} toots for shard {futures[future]}")
+            except Exception as e:
+                logger.warning(
+                    f"Backfill of shard {futures[future]} failed: {str(e)}")
+
+    if not all([shard["done"] for shard in state["shards"].values()]):
+        logger.warning(
+            f"Backfill incomplete, run again to resume from {state_file}")
+        if verbose and logger.level >= 20:
+            logger.setLevel(logging.WARNING)
+        return None
+
+    # merge shards into a regular timelines file, shards overlap only on retries
+    file_name = f"{data_dir}/{datetime.now().strftime('%s')}_timelines.json"
+    n_toots = 0
+    with open(f"{file_name}.tmp", "w") as out:
+        out.write("{")
+        for i, instance in enumerate(state["instances"]):
+            seen_ids = set()
+            out.write(f"{',' if i else ''}{json.dumps(instance)}: [")
+            for shard in state["shards"].values():
+                if shard["instance"] != instance:
+                    continue
+                shard_file = f"{shard_dir}/{instance}_{shard['min_id']}.jsonl"
+                if not os.path.isfile(shard_file):
+                    continue
+                with open(shard_file, "r") as f:
+                    for line in f:
+                        toot = json.loads(line)
+                        if toot["id"] in seen_ids:
+                            continue
+                        out.write(f"{',' if seen_ids else ''}{line.strip()}")
+                        seen_ids.add(toot["id"])
+            out.write("]")
+            n_toots += len(seen_ids)
+        out.write("}")
+    os.replace(f"{file_name}.tmp", file_name)
+    shutil.rmtree(shard_dir)
+    logger.info(f"Merged {n_toots} backfilled toots into {file_name}")
+
+    if verbose and logger.level >= 20:
+        logger.setLevel(logging.WARNING)
+
+    return {"file_name": file_name, "n_toots": n_toots, "instances": state["instances"], "hashtag": state["hashtag"], "filter_query": state["filter_query"], "local_only": state["local_only"], "end_date": state["end_date"]}
+
+
+class Reservoir:
+    # Algorithm R, one reservoir of `size` toots per stratum
+    def __init__(self, size, stratify_by=None, file_name=None, flush_interval=300):
+        self.size = size
+        self.stratify_by = stratify_by
+        self.file_name = file_name
+        self.flush_interval = flush_interval
+        self.strata = {}
+        self.n_seen = Counter()
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def get_stratum(self, status, instance_name=None):
+        if self.stratify_by == "instance":
+            return instance_name
+        elif self.stratify_by == "language":
+            return status["language"] if status["language"] else "und"
+        elif self.stratify_by == "hour":
+            try:
+                return f"{status['created_at']:%H}"
+            except:
+                return str(status["created_at"])[11:13]
+        else:
+            return "all"
+
+    def add(self, status, instance_name=None):
+        stratum = self.get_stratum(status, instance_name)
+        with self.lock:
+            self.n_seen[stratum] += 1
+            sample = self.strata.setdefault(stratum, [])
+            if len(sample) < self.size:
+                sample.append((instance_name, status))
+            else:
+                i = random.randrange(self.n_seen[stratum])
+                if i < self.size:
+                    sample[i] = (instance_name, status)
+        if self.file_name and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def update(self, status, instance_name=None):
+        stratum = self.get_stratum(status, instance_name)
+        with self.lock:
+            sample = self.strata.get(stratum, [])
+            for i, (_, sampled_status) in enumerate(sample):
+                if sampled_status["uri"] == status["uri"]:
+                    sample[i] = (instance_name, status)
+                    break
+
+    def to_timelines(self):
+        timelines = {}
+        with self.lock:
+            for sample in self.strata.values():
+                for instance_name, status in sample:
+                    timelines.setdefault(instance_name, []).append(status)
+        return timelines
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.file_name:
+            return
+        with self.flush_lock:
+            write_json_atomic(self.to_timelines(), self.file_name)
+        n_sampled = sum([len(sample) for sample in self.strata.values()])
+        logger.info(
+            f"Flushed {n_sampled} of {sum(self.n_seen.values())} streamed toots to {self.file_name}")
+
+
 class Sampler(mastodon.StreamListener):
     def __init__(self, file_name="toots", filter_string=None):
         self.n_toots = 0
@@ -1066,7 +2941,56 @@ class Sampler(mastodon.StreamListener):
             f.write("\n")
 
 
-def stream_timeline(api_bases, access_token=None, max_toots=None, timeframe=None, filter_string=None, dir_name=None, verbose=False):
+class ReservoirSampler(Sampler):
+    def __init__(self, reservoir, instance_name=None, filter_string=None):
+        super().__init__(file_name=None, filter_string=filter_string)
+        self.reservoir = reservoir
+        self.instance_name = instance_name
+
+    def on_update(self, status):
+        status["queried_at"] = datetime.now()
+        self.n_toots += 1
+        if filter_toots([status], query=self.filter_string):
+            self.reservoir.add(status, instance_name=self.instance_name)
+
+    def on_status_update(self, status):
+        status["queried_at"] = datetime.now()
+        self.reservoir.update(status, instance_name=self.instance_name)
+
+
+class StreamBuffer(Sampler):
+    # streamed toots of one instance until they are written, disconnects mark a gap
+    def __init__(self, instance_name=None):
+        super().__init__(file_name=None)
+        self.instance_name = instance_name
+        self.lock = threading.Lock()
+        self.toots = {}
+        # toots posted before the subscription are only found by polling from the cursor
+        self.gap = True
+
+    def on_update(self, status):
+        status["queried_at"] = datetime.now()
+        with self.lock:
+            self.n_toots += 1
+            self.toots[status["id"]] = status
+
+    def on_status_update(self, status):
+        status["queried_at"] = datetime.now()
+        with self.lock:
+            self.toots[status["id"]] = status
+
+    def on_abort(self, err):
+        logger.warning(f"Stream of {self.instance_name} was interrupted: {err}")
+        self.gap = True
+
+    def take(self):
+        with self.lock:
+            toots = sorted(self.toots.values(), key=lambda t: t["id"])
+            self.toots = {}
+        return toots
+
+
+def stream_timeline(api_bases, access_token=None, max_toots=None, timeframe=None, filter_string=None, dir_name=None, sample_size=None, stratify_by=None, flush_interval=300, verbose=False):
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.INFO)
@@ -1074,13 +2998,27 @@ def stream_timeline(api_bases, access_token=None, max_toots=None, timeframe=None
     start_time = int(time.time())
     time_passed = int(time.time()) - start_time
 
+    if sample_size:
+        reservoir = Reservoir(sample_size, stratify_by=stratify_by,
+                              file_name=f"{dir_name}/{start_time}_sample.json", flush_interval=flush_interval)
+    else:
+        reservoir = None
+
     streams = []
     try:
         for api_base in api_bases:
             print(api_base)
+            if not access_token and api_base in access_tokens.keys():
+                instance_token = access_tokens[api_base]
+            else:
+                instance_token = access_token
             api = mastodon.Mastodon(
-                api_base_url=api_base, access_token=access_token, user_agent=USER_AGENT)
-            stream_listener = Sampler(file_name=f"{dir_name}/{api_base}.json")
+                api_base_url=api_base, access_token=instance_token, user_agent=USER_AGENT)
+            if reservoir:
+                stream_listener = ReservoirSampler(
+                    reservoir, instance_name=api_base, filter_string=filter_string)
+            else:
+                stream_listener = Sampler(file_name=f"{dir_name}/{api_base}.json")
             streams.append((api_base, api.stream_public(listener=stream_listener, run_async=True,
                            reconnect_async=True, reconnect_async_wait_sec=30), stream_listener))
         while time_passed < timeframe:
@@ -1088,7 +3026,7 @@ def stream_timeline(api_bases, access_token=None, max_toots=None, timeframe=None
             for api_base, handler, listener in streams:
                 print(f"{api_base : <22}{listener.n_toots}")
             print(f"{timeframe - time_passed} seconds to go")
-            time.sleep(60*5)
+            time.sleep(min(60*5, max(timeframe - time_passed, 0)))
 
     except Exception as e:
         print("Error")
@@ -1096,6 +3034,8 @@ def stream_timeline(api_bases, access_token=None, max_toots=None, timeframe=None
     finally:
         for api_base, handler, listener in streams:
             handler.close()
+        if reservoir:
+            reservoir.flush()
 
     if verbose and logger.level >= 20:
         logger.setLevel(logging.WARNING)
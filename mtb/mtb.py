@@ -4,10 +4,14 @@ import csv
 import json
 import random
 import sys
+import threading
+import time
 from os import path, listdir, remove
 from shutil import rmtree
 from datetime import datetime, timedelta
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 from statistics import mean
 from glob import glob
 from boltons import timeutils
@@ -33,30 +37,47 @@ def run_instances(args):
         print(
             f"Getting up to {args.max_followers} followers for {len(user_urls)} accounts")
 
-        all_followers = []
-        for i, account_url in enumerate(user_urls, start=1):
-            try:
-                followers = mf.get_account_followers(
-                    account_url, max_followers=args.max_followers, verbose=False)
-                all_followers.extend(followers)
-                message = f"{i}/{len(user_urls)}: Got {len(followers)} followers of {account_url}"
-                print(f'{message: <70}', end="\r")
-            except:
-                pass
-
+        domains = Counter()
+        follower_urls = set()
+        lock = threading.Lock()
+        limiter = mf.HostLimiter(max_per_host=1, min_interval=args.request_interval)
         if args.save_followers:
-            writer = csv.writer(args.save_followers, dialect="unix")
-            writer.writerow(mf.account_key_names+["src_acct"])
-            for follower in mf.accounts_to_lines(all_followers, parse_html=True):
-                writer.writerow(follower+[account_url])
-            args.save_followers.close()
+            sink = mf.AccountsCSVSink(args.save_followers, parse_html=True, extra_columns=["src_acct"])
+        else:
+            sink = None
+
+        store = mf.AccountStore(args.account_store)
+
+        def crawl_followers(account_url):
+            n_followers = 0
+            for page in mf.iter_account_followers_pages(account_url, max_followers=args.max_followers, limiter=limiter):
+                store.put_many(page, source=urlparse(account_url).netloc)
+                with lock:
+                    for follower in page:
+                        acct = mf.acct_to_string(follower)
+                        domains[acct.split("@")[1] if "@" in acct else urlparse(follower["url"]).netloc] += 1
+                        follower_urls.add(follower["url"])
+                    if sink:
+                        sink.write(page, extra_values=[account_url])
+                n_followers += len(page)
+            return n_followers
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = dict([(executor.submit(crawl_followers, account_url), account_url) for account_url in user_urls])
+            for i, future in enumerate(as_completed(futures), start=1):
+                try:
+                    message = f"{i}/{len(user_urls)}: Got {future.result()} followers of {futures[future]}"
+                    print(f'{message: <70}', end="\r")
+                except:
+                    pass
+
+        if sink:
+            sink.close()
+        store.close()
 
-        message = f"Got {len(set([a['url'] for a in all_followers]))} followers for {len(user_urls)} accounts"
+        message = f"Got {len(follower_urls)} followers for {len(user_urls)} accounts"
         print(f'{message: <70}', end="\n\n")
-        domains = [mf.acct_to_string(follower).split("@")[1]
-                   for follower in all_followers]
-        domains = [(domain, count) for domain, count in Counter(
-            domains).most_common() if count >= args.min_users_per_domain]
+        domains = [(domain, count) for domain, count in domains.most_common() if count >= args.min_users_per_domain]
 
         with open(args.instances_file, "w") as f:
             print(
@@ -66,8 +87,11 @@ def run_instances(args):
                 print(f"{instance}: {count} users")
 
         if args.save_instances_meta:
-            instances = mf.get_instances_by_url(
-                [domain for domain, count in domains], file_name=args.save_instances_meta)
+            with mf.InstanceStore(args.instance_store, max_age=args.max_age*60*60) as instance_store:
+                instances = mf.get_instances_by_url(
+                    [domain for domain, count in domains], file_name=args.save_instances_meta, include_peers=args.include_peers,
+                    max_depth=args.peers_depth, max_instances=args.max_instances, max_workers=args.workers, store=instance_store, verbose=True)
+            print(f"Saved meta information for {len(instances)} instances to {args.save_instances_meta}")
     else:
         print(f"Getting instances that match the following criteria:")
         if args.sort_by:
@@ -93,17 +117,214 @@ def run_instances(args):
 
         if args.save_instances_meta:
             print(f"\nGetting meta information for {len(instances)} instances and saving it to {args.save_instances_meta} (this might take a while)")
-            instances = mf.get_instances_by_url(
-                [instance["name"] for instance in instances], file_name=args.save_instances_meta)
+            with mf.InstanceStore(args.instance_store, max_age=args.max_age*60*60) as instance_store:
+                instances = mf.get_instances_by_url(
+                    [instance["name"] for instance in instances], file_name=args.save_instances_meta, include_peers=args.include_peers,
+                    max_depth=args.peers_depth, max_instances=args.max_instances, max_workers=args.workers, store=instance_store, verbose=True)
+
+
+def checkpoint_search(data_dir, config, sink=None, sightings=None, uri_set=None):
+    # the cursor only ever covers toots that already are on disk
+    if uri_set:
+        config["uri_generation"] = uri_set.committed
+    if sink:
+        config["pending"] = sink.checkpoint()
+    else:
+        config.pop("pending", None)
+    if sightings:
+        config["pending_sightings"] = sightings.checkpoint()
+    else:
+        config.pop("pending_sightings", None)
+    config["last_checked"] = datetime.now().timestamp()
+    mf.write_json_atomic(config, f"{data_dir}/search_config.json")
+
+
+def recover_search(config_file, data_dir):
+    if config_file.get("dedup") and path.exists(f"{data_dir}/seen_uris.db"):
+        # hashes committed after the checkpoint belong to toots that are truncated below
+        uri_set = mf.UriSet(f"{data_dir}/seen_uris.db")
+        uri_set.rollback(config_file.get("uri_generation", 0))
+        uri_set.close()
+    if config_file.get("pending"):
+        mf.recover_timelines(**config_file["pending"])
+        print(
+            f"Recovered {config_file['pending']['file_name']} from an interrupted run", end="\n")
+    if config_file.get("pending_sightings"):
+        mf.truncate_file(**config_file["pending_sightings"])
+
+
+def open_dedup(data_dir, dedup, config):
+    if dedup:
+        uri_set = mf.UriSet(f"{data_dir}/seen_uris.db")
+        config["uri_generation"] = uri_set.committed
+        return uri_set, mf.SightingsSink(f"{data_dir}/sightings.csv")
+    return None, None
+
+
+def open_engagement(data_dir, track_engagement):
+    if track_engagement:
+        return mf.EngagementStore(f"{data_dir}/engagement.db")
+    return None
+
+
+def store_page(data_dir, config, instance, page, sink, uri_set=None, sightings=None, engagement=None):
+    if engagement:
+        engagement.add(page, instance_name=instance)
+    if uri_set:
+        page, seen_page = uri_set.split(page)
+        sightings.write(seen_page, instance_name=instance)
+    sink.write(page, instance_name=instance)
+    # committed first, a crash before the checkpoint rolls the hashes back in recover_search
+    if uri_set:
+        uri_set.commit()
+    checkpoint_search(data_dir, config, sink, sightings, uri_set)
+    if engagement:
+        engagement.commit()
+    return page
+
+
+def run_backfill(args, kind):
+    if not path.exists(f"{args.data_dir}/backfill/state.json"):
+        if not args.instances:
+            print("Please provide a list of instances via --instances", end="\n")
+            exit()
+        if kind == "hashtag" and not args.tag:
+            print("Please chose a hashtag via --tag", end="\n")
+            exit()
+        if not args.start_date or not args.end_date:
+            print("Backfills need --start_date and --end_date (YYYY-MM-DD)", end="\n")
+            exit()
+        instances = [i.strip() for i in args.instances.readlines()]
+        args.instances.close()
+        print(
+            f"Backfilling {args.start_date:%Y-%m-%d} to {args.end_date:%Y-%m-%d} on {len(instances)} instances in {args.shards} shards each", end="\n")
+    else:
+        instances = None
+        print(f"Resuming backfill in ./{args.data_dir}", end="\n")
+
+    result = mf.backfill_timelines(args.data_dir, instances=instances, start_date=args.start_date, end_date=args.end_date,
+                                   hashtag=args.tag.replace("#", "").lower() if kind == "hashtag" and args.tag else None,
+                                   filter_query=args.filter if kind == "public" else None, local_only=args.local_only,
+                                   n_shards=args.shards, max_workers=args.workers, max_per_host=args.per_host, verbose=True)
+    if not result:
+        print("Backfill incomplete, run the same command again to resume", end="\n")
+        return
+
+    # continue polling from the end of the backfilled range
+    if not path.exists(f"{args.data_dir}/search_config.json"):
+        config = {
+            "instances": result["instances"],
+            "local_only": result["local_only"],
+            "min_ids": dict([(k, result["end_date"]) for k in result["instances"]]),
+            "last_checked": datetime.now().timestamp()
+        }
+        if kind == "hashtag":
+            config["hashtag"] = result["hashtag"]
+            config["end_date"] = None
+        else:
+            config["filter_query"] = result["filter_query"]
+        mf.write_json_atomic(config, f"{args.data_dir}/search_config.json")
+    print(
+        f"Backfilled {result['n_toots']} toots from {len(result['instances'])} instances into {result['file_name']}", end="\n")
+
+
+def new_timelines_file(data_dir):
+    timestamp = int(datetime.now().timestamp())
+    while path.exists(f"{data_dir}/{timestamp}_timelines.json"):
+        timestamp += 1
+    return f"{data_dir}/{timestamp}_timelines.json"
+
+
+def stream_hashtag_search(args, config, instances, hashtag, hashtags, min_ids, local_only,
+                          iter_instance_pages, uri_set, sightings, engagement, uris):
+    # streamed toots are buffered and written every flush_interval, instances
+    # without a healthy stream are polled from their cursor instead. Every flush
+    # is a new timelines file (an instance can only be written once per file),
+    # so flushes are hourly by default, the cursor only advances when written
+    streams = {}
+    for instance in instances:
+        if instance in mf.access_tokens.keys():
+            access_token = mf.access_tokens[instance]
+        else:
+            access_token = None
+        listener = mf.StreamBuffer(instance_name=instance)
+        handlers = []
+        try:
+            api = mf.get_api(instance, access_token=access_token)
+            for tag in hashtags if hashtags else [hashtag]:
+                handlers.append(api.stream_hashtag(tag, listener, local=local_only, run_async=True,
+                                                   reconnect_async=True, reconnect_async_wait_sec=30))
+        except Exception as e:
+            print(f"Could not stream from {instance} ({e}), polling instead", end="\n")
+        streams[instance] = (listener, handlers, access_token)
+
+    def flush_streams():
+        n_toots = 0
+        with mf.TimelinesSink(new_timelines_file(args.data_dir)) as sink:
+            for instance, (listener, handlers, access_token) in streams.items():
+                receiving = bool(handlers) and all([handler.is_receiving() for handler in handlers])
+                if not receiving:
+                    listener.gap = True
+                toots = listener.take()
+                if listener.gap:
+                    for page in iter_instance_pages(instance, access_token):
+                        toots.extend(page)
+                    if receiving:
+                        listener.gap = False
+                toots = list(dict([(t["id"], t) for t in toots]).values())
+                if not toots:
+                    continue
+                # the streams covered everything up to the newest toot
+                max_id = max([t["id"] for t in toots])
+                if hashtags:
+                    mf.add_tracked_tags(toots, hashtags)
+                    for key in min_ids[instance].keys():
+                        min_ids[instance][key] = max(min_ids[instance][key], max_id)
+                else:
+                    min_ids[instance] = max(min_ids[instance], max_id)
+                page = store_page(args.data_dir, config, instance, mf.filter_toots(toots), sink, uri_set, sightings, engagement)
+                uris.update([t["uri"] for t in page])
+                n_toots += len(page)
+        checkpoint_search(args.data_dir, config)
+        return n_toots
+
+    n_streams = len([instance for instance, (listener, handlers, access_token) in streams.items() if handlers])
+    print(f"\nStreaming from {n_streams} of {len(instances)} instances, saving every {args.flush_interval} seconds", end="\n")
+    start_time = time.time()
+    try:
+        while not args.timeframe or time.time() - start_time < args.timeframe:
+            if args.timeframe:
+                time.sleep(min(args.flush_interval, max(args.timeframe - (time.time() - start_time), 0)))
+            else:
+                time.sleep(args.flush_interval)
+            n_toots = flush_streams()
+            message = f"{datetime.now():%Y-%m-%d %H:%M:%S}: Saved {n_toots} toots, {len(uris)} in total"
+            print(f'{message: <70}', end="\r")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for listener, handlers, access_token in streams.values():
+            for handler in handlers:
+                handler.close()
+        flush_streams()
 
 
 def run_hashtag(args):
+    if args.backfill:
+        run_backfill(args, "hashtag")
+        return
+
     if not path.exists(f"{args.data_dir}/search_config.json"):
-        if not args.tag:
-            print("Please chose a hashtag via --tag", end="\n")
+        if args.tags:
+            hashtag = None
+            hashtags = list(dict.fromkeys([t.strip().replace("#", "").lower() for t in args.tags.readlines() if t.strip()]))
+            args.tags.close()
+        elif not args.tag:
+            print("Please chose a hashtag via --tag or a file of hashtags via --tags", end="\n")
             exit()
         else:
             hashtag = args.tag.replace("#", "").lower()
+            hashtags = None
 
         if not args.instances:
             print("Please provide a list of instances via --instances", end="\n")
@@ -112,15 +333,21 @@ def run_hashtag(args):
             instances = [i.strip() for i in args.instances.readlines()]
             args.instances.close()
         print(
-            f"Initialising a search on {len(instances)} instances for #{hashtag} in ./{args.data_dir}", end="\n")
+            f"Initialising a search on {len(instances)} instances for {f'#{hashtag}' if hashtag else f'{len(hashtags)} hashtags'} in ./{args.data_dir}", end="\n")
         try:
-            min_id = args.start_date
-            min_ids = dict([(k, min_id) for k in instances])
+            min_id = mf.snowflake_from_datetime(args.start_date)
+            if hashtags:
+                # one cursor per batch of hashtags
+                min_ids = dict([(k, dict([(",".join(batch), min_id) for batch in mf.batch_tags(hashtags)])) for k in instances])
+            else:
+                min_ids = dict([(k, min_id) for k in instances])
         except:
             print("For new searches --start_date must be set (YYYY-MM-DD)", end="\n")
             exit()
 
         local_only = args.local_only
+        dedup = args.dedup
+        track_engagement = args.track_engagement
 
         if args.end_date:
             end_date = (int(round(args.end_date.timestamp())) * 1000) << 16
@@ -131,61 +358,93 @@ def run_hashtag(args):
             config_file = json.load(f)
             last_checked = datetime.fromtimestamp(config_file["last_checked"])
             hashtag = config_file["hashtag"]
+            hashtags = config_file.get("hashtags")
             instances = config_file["instances"]
             local_only = config_file["local_only"]
             min_ids = config_file["min_ids"]
             end_date = config_file["end_date"]
+            dedup = config_file.get("dedup", False)
+            track_engagement = config_file.get("track_engagement", False)
         print(
             f"Refreshing timelines from {args.data_dir} on {len(instances)} instances, last checked at {last_checked:%Y-%m-%d %H:%M:%S}", end="\n")
+        recover_search(config_file, args.data_dir)
+
+    config = {
+        "hashtag": hashtag,
+        "hashtags": hashtags,
+        "instances": instances,
+        "local_only": local_only,
+        "min_ids": min_ids,
+        "end_date": end_date,
+        "dedup": dedup,
+        "track_engagement": track_engagement,
+        "last_checked": datetime.now().timestamp()
+    }
+    uri_set, sightings = open_dedup(args.data_dir, dedup, config)
+    engagement = open_engagement(args.data_dir, track_engagement)
+    uris = set()
+
+    def iter_instance_pages(instance, access_token):
+        # the cursor is moved before the page is stored and checkpointed
+        if not hashtags:
+            for page in mf.iter_hashtag_pages(hashtag, instance, access_token=access_token,
+                                              local_only=local_only, min_id=min_ids[instance], max_id=end_date):
+                min_ids[instance] = max([t["id"] for t in page])
+                yield page
+            return
+        seen_ids = set()
+        for batch in mf.batch_tags(hashtags):
+            key = ",".join(batch)
+            for page in mf.iter_tags_pages(batch, instance, access_token=access_token,
+                                           local_only=local_only, min_id=min_ids[instance][key], max_id=end_date):
+                min_ids[instance][key] = max([t["id"] for t in page])
+                # toots with hashtags from several batches are only stored once
+                page = [t for t in mf.add_tracked_tags(page, hashtags) if t["id"] not in seen_ids]
+                seen_ids.update([t["id"] for t in page])
+                yield page
+
+    with mf.TimelinesSink(f"{args.data_dir}/{datetime.now().strftime('%s')}_timelines.json") as sink:
+        for n, instance in enumerate(mf.health.rank(instances), start=1):
+            if instance in mf.access_tokens.keys():
+                access_token = mf.access_tokens[instance]
+            else:
+                access_token = None
+            n_toots = 0
+            for page in iter_instance_pages(instance, access_token):
+                page = store_page(args.data_dir, config, instance, mf.filter_toots(page), sink, uri_set, sightings, engagement)
+                uris.update([t["uri"] for t in page])
+                n_toots += len(page)
+            if n_toots:
+                message = f"{n}/{len(instances)}: Got {n_toots} toots from {instance}"
+            else:
+                message = f"{n}/{len(instances)}: Got no toots from {instance}"
+            print(f'{message: <70}', end="\r")
+
+    if args.stream and end_date:
+        print("\nSearches with an end date are not streamed", end="\n")
+    elif args.stream:
+        stream_hashtag_search(args, config, instances, hashtag, hashtags, min_ids, local_only,
+                              iter_instance_pages, uri_set, sightings, engagement, uris)
+
+    checkpoint_search(args.data_dir, config)
+    if uri_set:
+        uri_set.close()
+        sightings.close()
+    if engagement:
+        engagement.close()
 
-    timelines = {}
-    for n, instance in enumerate(instances, start=1):
-        if instance in mf.access_tokens.keys():
-            access_token = mf.access_tokens[instance]
-        else:
-            access_token = None
-        toots = mf.search_hashtag(hashtag, instance, access_token=access_token,
-                                  local_only=args.local_only, min_id=min_ids[instance], max_id=end_date, verbose=True)
-        timelines[instance] = mf.filter_toots(toots)
-        if timelines[instance]:
-            message = f"{n}/{len(instances)}: Got {len(timelines[instance])} toots from {instance}"
-        else:
-            message = f"{n}/{len(instances)}: Got no toots from {instance}"
-        print(f'{message: <70}', end="\r")
-
-    if not all([isinstance(timeline, type(None)) for timeline in timelines.values()]):
-        with open(f"{args.data_dir}/{datetime.now().strftime('%s')}_timelines.json", "w") as f:
-            json.dump(timelines, f, default=str)
-
-    with open(f"{args.data_dir}/search_config.json", "w") as f:
-        for instance in instances:
-            if timelines[instance] and len(timelines[instance]) > 0:
-                min_ids[instance] = max([t["id"] for t in timelines[instance]])
-            elif isinstance(min_ids[instance], datetime):
-                min_ids[instance] = (
-                    int(round(min_ids[instance].timestamp())) * 1000) << 16
-        config = {
-            "hashtag": hashtag,
-            "instances": instances,
-            "local_only": local_only,
-            "min_ids": min_ids,
-            "end_date": end_date,
-            "last_checked": datetime.now().timestamp()
-        }
-        json.dump(config, f, default=str)
-
-    uris = []
-    for tl in timelines.values():
-        if tl:
-            uris.extend([t["uri"] for t in tl])
     if uris:
         print(
-            f"\nGot {len(set(uris))} unique toots from {len(instances)} instances")
+            f"\nGot {len(uris)} unique toots from {len(instances)} instances")
     else:
         print(f"\nGot no new toots from {len(instances)} instances")
 
 
 def run_public(args):
+    if args.backfill:
+        run_backfill(args, "public")
+        return
+
     if not path.exists(f"{args.data_dir}/search_config.json"):
         if not args.instances:
             print("Please provide a list of instances")
@@ -200,14 +459,15 @@ def run_public(args):
             print(
                 f"Initialising a search on {len(instances)} instances in ./{args.data_dir}")
         try:
-            min_id = datetime.strptime(args.start_date, "%Y-%m-%d")
-            # min_id = (int(round(datetime.strptime(args.start_date, "%Y-%m-%d").timestamp())) * 1000) << 16
+            min_id = mf.snowflake_from_datetime(args.start_date)
             min_ids = dict([(k, min_id) for k in instances])
         except:
             print("For new searches --start_date must be set (YYYY-MM-DD)")
             exit()
         local_only = args.local_only
         filter_query = args.filter
+        dedup = args.dedup
+        track_engagement = args.track_engagement
     else:
         with open(f"{args.data_dir}/search_config.json", "r") as f:
             config_file = json.load(f)
@@ -216,47 +476,65 @@ def run_public(args):
             instances = config_file["instances"]
             min_ids = config_file["min_ids"]
             local_only = config_file["local_only"]
+            dedup = config_file.get("dedup", False)
+            track_engagement = config_file.get("track_engagement", False)
         print(
             f"Refreshing timelines from {args.data_dir} last checked at {last_checked:%Y-%m-%d %H:%M:%S}")
+        recover_search(config_file, args.data_dir)
+
+    config = {
+        "filter_query": filter_query,
+        "instances": instances,
+        "local_only": local_only,
+        "min_ids": min_ids,
+        "dedup": dedup,
+        "track_engagement": track_engagement,
+        "last_checked": datetime.now().timestamp()
+    }
+    uri_set, sightings = open_dedup(args.data_dir, dedup, config)
+    engagement = open_engagement(args.data_dir, track_engagement)
+    uris = set()
+    with mf.TimelinesSink(f"{args.data_dir}/{datetime.now().strftime('%s')}_timelines.json") as sink:
+        for instance in mf.health.rank(instances):
+            if instance in mf.access_tokens.keys():
+                access_token = mf.access_tokens[instance]
+            else:
+                access_token = None
 
-    timelines = {}
-    for instance in instances:
-        if instance in mf.access_tokens.keys():
-            access_token = mf.access_tokens[instance]
-        else:
-            access_token = None
-
-        toots = mf.search_public(
-            instance, access_token, min_id=min_ids[instance], local_only=args.local_only, verbose=True)
-        timelines[instance] = mf.filter_toots(toots, query=filter_query)
-
-    if not all([isinstance(timeline, type(None)) for timeline in timelines.values()]):
-        with open(f"{args.data_dir}/{datetime.now().strftime('%s')}_timelines.json", "w") as f:
-            json.dump(timelines, f, default=str)
+            for page in mf.iter_public_pages(instance, access_token=access_token, min_id=min_ids[instance], local_only=local_only):
+                min_ids[instance] = max([t["id"] for t in page])
+                page = store_page(args.data_dir, config, instance, mf.filter_toots(page, query=filter_query), sink, uri_set, sightings, engagement)
+                uris.update([t["uri"] for t in page])
 
-    with open(f"{args.data_dir}/search_config.json", "w") as f:
-        for instance in instances:
-            if timelines[instance] and len(timelines[instance]) > 0:
-                min_ids[instance] = max([t["id"] for t in timelines[instance]])
-        config = {
-            "filter_query": filter_query,
-            "instances": instances,
-            "local_only": local_only,
-            "min_ids": min_ids,
-            "last_checked": datetime.now().timestamp()
-        }
-        json.dump(config, f)
+    checkpoint_search(args.data_dir, config)
+    if uri_set:
+        uri_set.close()
+        sightings.close()
+    if engagement:
+        engagement.close()
 
-    uris = []
-    for tl in timelines.values():
-        if tl:
-            uris.extend([t["uri"] for t in tl])
     if uris:
-        print(f"\nGot {len(set(uris))} toots from {len(instances)} instances")
+        print(f"\nGot {len(uris)} toots from {len(instances)} instances")
     else:
         print(f"\nGot no new toots from {len(instances)} instances")
 
 
+def load_interactions(f):
+    # earlier runs are either one json object or one record per line (--stream)
+    try:
+        interactions = json.load(f)
+        records = [interactions] if "uri" in interactions else []
+    except json.JSONDecodeError:
+        f.seek(0)
+        records = [json.loads(line) for line in f if line.strip()]
+    if records:
+        interactions = {"reblogs": {}, "favourites": {}, "context": {}}
+        for record in records:
+            for kind in interactions.keys():
+                interactions[kind][record["uri"]] = record[kind]
+    return interactions
+
+
 def run_interactions(args):
     def to_rows(interactions):
         for kind, interaction in interactions.items():
@@ -284,12 +562,55 @@ def run_interactions(args):
     toots = json.load(args.toots)
     args.toots.close()
     print(f"Getting interactions with {len(toots)} toots.")
-    reblogs = mf.get_toots_reblogs(toots, verbose=True)
+    store = mf.AccountStore(args.account_store)
+    store.put_many([t["account"] for t in toots if "account" in t])
+    previous = {}
+    sources = None
+    if args.previous:
+        # refresh, only toots whose counts changed are paged again
+        previous = load_interactions(args.previous)
+        args.previous.close()
+        print(f"Refreshing interactions from {args.previous.name}.")
+
+    graph = mf.InteractionGraph(weighted=args.weighted) if args.graph_dir else None
+
+    if args.stream:
+        # one record per toot, written as soon as it is complete
+        engine = mf.ContextEngine(store=store) if args.save_context_toots else None
+        if args.format == "csv":
+            writer = csv.writer(args.out_file, dialect="unix")
+            writer.writerow(["destination", "source", "kind", "dest_uri", "src_uri"])
+        n_toots = 0
+        for uri, record in mf.iter_toots_interactions(toots, store=store, previous=previous, engine=engine, verbose=True):
+            if args.format == "json":
+                args.out_file.write(json.dumps({"uri": uri, **record}, default=str))
+                args.out_file.write("\n")
+            elif args.format == "csv":
+                for row in to_rows(dict([(kind, {uri: interaction}) for kind, interaction in record.items()])):
+                    writer.writerow(row)
+            if graph:
+                graph.update(to_rows(dict([(kind, {uri: interaction}) for kind, interaction in record.items()])))
+            args.out_file.flush()
+            n_toots += 1
+        if graph:
+            n_nodes, n_edges = graph.write(args.graph_dir)
+            print(f"Wrote graph with {n_nodes} nodes and {n_edges} edges to {args.graph_dir}")
+        if engine:
+            engine.write_csv("context_toots.csv", source_uris=set([t["uri"] for t in toots]), parse_html=args.parse_html)
+        store.close()
+        print(f"Got interactions for {n_toots} toots.")
+        return
+
+    if args.previous:
+        sources = mf.get_toot_sources(toots, verbose=True)
+    reblogs = mf.get_toots_reblogs(toots, store=store, sources=sources, previous=previous.get("reblogs"), verbose=True)
     print(f"Got reblogs for {len(toots)} toots.")
-    favourites = mf.get_toots_favourites(toots, verbose=True)
+    favourites = mf.get_toots_favourites(toots, store=store, sources=sources, previous=previous.get("favourites"), verbose=True)
     print(f"Got favourites for {len(toots)} toots.")
-    context = mf.get_toots_context(toots, verbose=True, save_toots =  args.save_context_toots, parse_html = args.parse_html)
+    context = mf.get_toots_context(toots, verbose=True, save_toots =  args.save_context_toots, parse_html = args.parse_html, store=store,
+                                   sources=sources, previous=previous.get("context"))
     print(f"Got replies for {len(toots)} toots.")
+    store.close()
     if args.format == "json":
         json.dump({"reblogs": reblogs, "favourites": favourites,
                   "context": context}, args.out_file, default=str)
@@ -298,10 +619,30 @@ def run_interactions(args):
         writer.writerow(["destination", "source", "kind", "dest_uri", "src_uri"])
         for row in to_rows({"reblogs": reblogs, "favourites": favourites, "context": context}):
             writer.writerow(row)
+    if graph:
+        graph.update(to_rows({"reblogs": reblogs, "favourites": favourites, "context": context}))
+        n_nodes, n_edges = graph.write(args.graph_dir)
+        print(f"Wrote graph with {n_nodes} nodes and {n_edges} edges to {args.graph_dir}")
         
         
 def run_export(args):
-    if not args.out_file:
+    if args.columns:
+        columns = [c.strip() for c in args.columns.split(",")]
+        try:
+            extract_toot = mf.compile_extractor(columns)
+        except ValueError as e:
+            print(f"Invalid --columns: {e}")
+            exit()
+    else:
+        columns = None
+
+    if args.partition_by:
+        if args.engagement or not (args.data_files or path.exists(f"{args.data_dir}/search_config.json")):
+            print("--partition_by is only supported when exporting timelines")
+            exit()
+        if not args.out_dir:
+            args.out_dir = f"{int(datetime.now().timestamp())}_export"
+    elif not args.out_file:
         args.out_file = open(
             f"{int(datetime.now().timestamp())}_export.{args.format}", "a")
     else:
@@ -312,7 +653,28 @@ def run_export(args):
                 pass
             args.out_file = open(fname, "a")
 
-    if path.exists(f"{args.data_dir}/search_config.json") or args.data_files: # Export timelines
+    if args.engagement: # Export engagement trajectories
+        engagement = mf.EngagementStore(f"{args.data_dir}/engagement.db")
+        n_toots = 0
+        try:
+            if args.format == "json":
+                for toot, trajectory in engagement.iter_trajectories():
+                    toot["trajectory"] = [dict(zip(mf.engagement_key_names, o)) for o in trajectory]
+                    json.dump(toot, args.out_file, default=str)
+                    args.out_file.write("\n")
+                    n_toots += 1
+                print(f"Wrote trajectories of {n_toots} toots to {args.out_file.name}")
+            elif args.format == "csv":
+                writer = csv.writer(args.out_file, dialect="unix")
+                writer.writerow(mf.engagement_key_names)
+                for observation in engagement.iter_observations():
+                    writer.writerow(observation)
+                    n_toots += 1
+                print(f"Wrote {n_toots} observations to {args.out_file.name}")
+        finally:
+            engagement.close()
+            args.out_file.close()
+    elif path.exists(f"{args.data_dir}/search_config.json") or args.data_files: # Export timelines
         if args.data_files:
             files = []
             for f in args.data_files:
@@ -323,11 +685,35 @@ def run_export(args):
             files = [f"{args.data_dir}/{f}" for f in listdir(args.data_dir) if not f.startswith(
                 ".") and f != "search_config.json" and f.endswith(".json")]
 
+        if args.aggregate and args.data_dir and path.exists(f"{args.data_dir}/sightings.csv"):
+            sightings = mf.read_sightings(f"{args.data_dir}/sightings.csv")
+        else:
+            sightings = {}
+
+        if args.partition_by:
+            partition_by = [k.strip() for k in args.partition_by.split(",")]
+            with mf.PartitionedSink(args.out_dir, partition_by, parse_html=args.parse_html, columns=columns,
+                                    file_format=args.format, max_open_files=args.max_open_files) as sink:
+                if args.aggregate:
+                    for instance, uri, toot in mf.aggregate_timelines(files, sightings=sightings):
+                        # instance is a json list of every instance the toot was seen on, the first one partitions it
+                        sink.write([toot], instance_name=instance, partition_instance=json.loads(instance)[0])
+                else:
+                    for fname in files:
+                        with open(f"{fname}", "r") as f:
+                            for instance, toots in json.load(f).items():
+                                if toots:
+                                    sink.write(toots, instance_name=instance)
+            print(f"Wrote {sink.n_items} toots to {len(sink.partitions)} partitions in {args.out_dir}")
+            return
+
         try:
             if args.format == "json":
                 if args.aggregate:
                     toots = []
-                    for instance, uri, toot in mf.aggregate_timelines(files):
+                    for instance, uri, toot in mf.aggregate_timelines(files, sightings=sightings):
+                        if columns:
+                            toot = extract_toot(toot, instance_name=instance, parse_html=args.parse_html)._asdict()
                         toot["queried_instance"] = instance
                         toots.append(toot)
                     json.dump(toots, args.out_file, default=str)
@@ -342,6 +728,8 @@ def run_export(args):
                                     continue
                                 for toot in toots:
                                     n_toots += 1
+                                    if columns:
+                                        toot = extract_toot(toot, instance_name=instance, parse_html=args.parse_html)._asdict()
                                     toot["queried_instance"] = instance
                                     json.dump(toot, args.out_file, default=str)
                                     args.out_file.write("\n")
@@ -351,14 +739,13 @@ def run_export(args):
 
             elif args.format == "csv":
                 writer = csv.writer(args.out_file, dialect="unix")
-                writer.writerow(mf.key_names)
+                writer.writerow(columns if columns else mf.key_names)
                 if args.aggregate:
                     n_toots = 0
-                    for instance, uri, toot in mf.aggregate_timelines(files):
-                        toot = mf.toots_to_lines(
-                            [toot], parse_html=args.parse_html, instance_name=instance, verbose=False)
-                        writer.writerow(toot[0])
-                        n_toots += 1
+                    for instance, uri, toot in mf.aggregate_timelines(files, sightings=sightings):
+                        for line in mf.toots_to_lines([toot], parse_html=args.parse_html, instance_name=instance, columns=columns, verbose=False):
+                            writer.writerow(line)
+                            n_toots += 1
                     print(
                         f"Wrote {n_toots} unique toots to {args.out_file.name}")
                 else:
@@ -366,7 +753,7 @@ def run_export(args):
                     for fname in files:
                         with open(f"{fname}", "r") as f:
                             for instance, toots in json.load(f).items():
-                                for toot in mf.toots_to_lines(toots, parse_html=args.parse_html, instance_name=instance, verbose=False):
+                                for toot in mf.toots_to_lines(toots, parse_html=args.parse_html, instance_name=instance, columns=columns, verbose=False):
                                     writer.writerow(toot)
                                     n_toots += 1
                     print(
@@ -376,54 +763,42 @@ def run_export(args):
         finally:
             args.out_file.close()
     else: # Export trends
-        files = [f for f in listdir(args.data_dir) if not f.startswith(
-            ".") and f.endswith("_trends.json")]
-        all_tags = {}
-        all_links = {}
-        all_statuses = {}
-        for fname in files:
-            with open(f"{args.data_dir}/{fname}", "r") as f:
-                for instance, trends in json.load(f).items():
-                    if not trends:
-                        continue
-                    if instance in all_tags:
-                        all_tags[instance].extend(trends["tags"])
-                    else:
-                        all_tags[instance] = trends["tags"]
-                    if instance in all_links:
-                        all_links[instance].extend(trends["links"])
-                    else:
-                        all_links[instance] = trends["links"]
-                    if instance in all_statuses:
-                        all_statuses[instance].extend(trends["statuses"])
-                    else:
-                        all_statuses[instance] = trends["statuses"]
+        files = [f"{args.data_dir}/{f}" for f in listdir(args.data_dir) if not f.startswith(
+            ".") and (f.endswith("_trends.json") or f.endswith("_trends_diff.json"))]
+        # one row per (name or url, day, instance) and toot per (uri, instance), later snapshots win
+        tags = {}
+        links = {}
+        statuses = {}
+        for instance, trends in mf.iter_trends_snapshots(files):
+            for tag in trends["tags"]:
+                for history in tag["history"]:
+                    tags[(tag["name"], history["day"], instance)] = [tag[k] for k in mf.trends_key_names["tags"]] + [
+                        history["day"], history["accounts"], history["uses"], instance]
+            for link in trends["links"]:
+                for history in link["history"]:
+                    links[(link["url"], history["day"], instance)] = [link[k] for k in mf.trends_key_names["links"]] + [
+                        history["day"], history["accounts"], history["uses"], instance]
+            for status in trends["statuses"]:
+                for line in mf.toots_to_lines([status], parse_html=args.parse_html, instance_name=instance):
+                    statuses[(status["uri"], instance)] = line
 
         with open(f"tags.csv", "w") as tag_file:
             tag_writer = csv.writer(tag_file, dialect="unix")
             tag_writer.writerow(
                 mf.trends_key_names["tags"] + ["day", "accounts", "uses", "instance"])
-            for instance, tags in all_tags.items():
-                for tag in tags:
-                    for history in tag["history"]:
-                        day, accounts, uses = history.values()
-                        tag_writer.writerow(
-                            [tag[k] for k in mf.trends_key_names["tags"]] + [day, accounts, uses, instance])
+            tag_writer.writerows(tags.values())
 
         with open(f"links.csv", "w") as link_file:
             link_writer = csv.writer(link_file, dialect="unix")
             link_writer.writerow(
                 mf.trends_key_names["links"] + ["day", "accounts", "uses", "instance"])
-            for instance, links in all_links.items():
-                for link in links:
-                    for history in link["history"]:
-                        day, accounts, uses = history.values()
-                        link_writer.writerow(
-                            [link[k] for k in mf.trends_key_names["links"]] + [day, accounts, uses, instance])
+            link_writer.writerows(links.values())
 
-        for instance, statuses in all_statuses.items():
-            mf.toots_to_csv(statuses, file_name="statuses.csv", parse_html=args.parse_html,
-                            instance_name=instance, append=True, verbose=False)
+        with open(f"statuses.csv", "w") as status_file:
+            status_writer = csv.writer(status_file, dialect="unix")
+            status_writer.writerow(mf.key_names)
+            status_writer.writerows(statuses.values())
+        print(f"Wrote {len(tags)} tag, {len(links)} link and {len(statuses)} status rows")
 
 
 def run_sample(args):
@@ -435,6 +810,14 @@ def run_sample(args):
         instances = [i.strip() for i in args.instances.readlines()]
         args.instances.close()
 
+    if args.size:
+        data_dir = args.data_dir if args.data_dir else "."
+        print(
+            f"Sampling {args.size} toots per {args.stratify_by if args.stratify_by else 'stream'} from {len(instances)} instances for {args.timeframe} seconds")
+        mf.stream_timeline(instances, timeframe=args.timeframe, filter_string=args.filter, dir_name=data_dir,
+                           sample_size=args.size, stratify_by=args.stratify_by, flush_interval=args.flush_interval, verbose=True)
+        return
+
     if not args.start_date or not args.end_date:
         print("Please provide a list of instances")
         exit()
@@ -502,7 +885,6 @@ def run_sample(args):
 
 
 def run_trends(args):
-    trends = {}
     if not args.instances:
         print("Please provide a list of instances")
         exit()
@@ -510,17 +892,60 @@ def run_trends(args):
         instances = [i.strip() for i in args.instances.readlines()]
         args.instances.close()
 
-    for instance in instances:
-        if instance in mf.access_tokens.keys():
-            access_token = mf.access_tokens[instance]
-        else:
-            access_token = None
-        trends[instance] = mf.get_instance_trends(
-            instance, access_token=access_token, verbose=True)
-
-    if not all([isinstance(trends, type(None)) for timeline in trends.values()]):
-        with open(f"{args.data_dir}/{datetime.now().strftime('%s')}_trends.json", "w") as f:
-            json.dump(trends, f, default=str)
+    # last full snapshot per instance, polls only store the difference to it
+    state_file = f"{args.data_dir}/trends_state.json"
+    if path.exists(state_file):
+        with open(state_file, "r") as f:
+            state = json.load(f)
+    else:
+        state = {}
+
+    n_polls = 0
+    while True:
+        queried_trends = mf.get_trends(instances, max_workers=args.workers, verbose=True)
+        # compare what would be read back from disk
+        trends = json.loads(json.dumps(queried_trends, default=str))
+        timestamp = datetime.now().strftime('%s')
+
+        if not all([instance_trends is None for instance_trends in trends.values()]):
+            if args.interval:
+                diffs = {}
+                snapshot = {}
+                for instance, instance_trends in trends.items():
+                    if not instance_trends:
+                        continue
+                    if instance in state:
+                        diff = mf.diff_trends(state[instance], instance_trends)
+                        if not mf.is_empty_trends_diff(diff):
+                            diffs[instance] = diff
+                    else:
+                        snapshot[instance] = instance_trends
+                if snapshot:
+                    mf.write_json_atomic(snapshot, f"{args.data_dir}/{timestamp}_trends.json")
+                if diffs:
+                    mf.write_json_atomic(diffs, f"{args.data_dir}/{timestamp}_trends_diff.json")
+                print(f"Got {len(snapshot)} new and {len(diffs)} changed trends at {timestamp}")
+            else:
+                with open(f"{args.data_dir}/{timestamp}_trends.json", "w") as f:
+                    json.dump(trends, f, default=str)
+
+            for instance, instance_trends in trends.items():
+                if instance_trends:
+                    state[instance] = instance_trends
+            mf.write_json_atomic(state, state_file)
+
+        if args.track_engagement:
+            engagement = mf.EngagementStore(f"{args.data_dir}/engagement.db")
+            for instance, instance_trends in queried_trends.items():
+                if instance_trends:
+                    engagement.add(instance_trends["statuses"], instance_name=instance)
+            engagement.commit()
+            engagement.close()
+
+        n_polls += 1
+        if not args.interval or (args.polls and n_polls >= args.polls):
+            break
+        time.sleep(args.interval)
 
 def run_users(args):
     try:
@@ -529,10 +954,85 @@ def run_users(args):
         pass
     finally:
         args.user_urls.close()    
-    accounts = mf.get_accounts_by_url(user_urls, file_name=args.out_file, parse_html=args.parse_html, verbose=True)
+    with mf.AccountStore(args.account_store, max_age=args.max_age*60*60) as store:
+        accounts = mf.get_accounts_by_url(user_urls, file_name=args.out_file, parse_html=args.parse_html, max_workers=args.workers, store=store, verbose=True)
     message = f"Got metadata for {len(accounts)} users and saved to {args.out_file}"
     print(f'{message:{get_terminal_size().columns}.{get_terminal_size().columns}}')
+
+    if args.get_posts:
+        # newest post id per user, so that a rerun only fetches new posts
+        cursor_file = f"{args.posts_file}.cursors.json"
+        if path.exists(cursor_file) and path.exists(args.posts_file):
+            with open(cursor_file, "r") as f:
+                cursors = json.load(f)
+        else:
+            cursors = {}
+        print(f"Getting posts of {len(accounts)} users ({len(cursors)} already seen)")
+        with mf.TootsCSVSink(args.posts_file, parse_html=args.parse_html, append=True) as sink:
+            try:
+                n_posts = mf.get_accounts_posts(accounts, sink, cursors=cursors, max_posts=args.max_posts,
+                                                max_workers=args.workers, verbose=True)
+            finally:
+                mf.write_json_atomic(cursors, cursor_file)
+        print(f"Got {sum(n_posts.values())} new posts of {len(n_posts)} users and saved to {args.posts_file}")
     
+def run_toots(args):
+    if not args.urls:
+        print("Please provide a file with toot urls via --urls")
+        exit()
+    urls = [url.strip() for url in args.urls.readlines() if url.strip()]
+    args.urls.close()
+    if not args.out_file:
+        args.out_file = f"{int(datetime.now().timestamp())}_toots.{'csv' if args.format == 'csv' else 'jsonl'}"
+
+    print(f"Resolving {len(urls)} toots")
+    if args.format == "csv":
+        sink = mf.TootsCSVSink(args.out_file, parse_html=args.parse_html)
+    else:
+        sink = mf.JSONLinesSink(args.out_file)
+    with mf.StatusStore(args.status_store) as store, sink:
+        toots, failed, unsupported = mf.get_toots_by_url(urls, sink=sink, store=store, max_workers=args.workers,
+                                                         max_per_host=args.per_host, verbose=True)
+    message = f"Resolved {sink.n_items} toots and saved to {args.out_file}"
+    print(f'{message: <70}', end="\n")
+    if failed:
+        with open(f"{args.out_file}.failed.txt", "w") as f:
+            f.write("\n".join(failed))
+            f.write("\n")
+        print(f"Could not resolve {len(failed)} toots, see {args.out_file}.failed.txt")
+    if unsupported:
+        with open(f"{args.out_file}.unsupported.txt", "w") as f:
+            f.write("\n".join(unsupported))
+            f.write("\n")
+        print(f"{len(unsupported)} urls without a status id need an access token for their instance, see {args.out_file}.unsupported.txt")
+
+
+def run_media(args):
+    if args.toots:
+        toots = [(toot.get("queried_instance"), toot) for toot in json.load(args.toots)]
+        args.toots.close()
+    elif args.data_dir and path.exists(args.data_dir):
+        files = [f"{args.data_dir}/{f}" for f in listdir(args.data_dir) if not f.startswith(
+            ".") and f != "search_config.json" and f.endswith(".json")]
+        toots = []
+        for fname in sorted(files):
+            with open(fname, "r") as f:
+                for instance, instance_toots in json.load(f).items():
+                    toots += [(instance, toot) for toot in instance_toots or []]
+    else:
+        print("Please provide toots via --toots or a data directory via --data_dir")
+        exit()
+    if not args.out_dir:
+        args.out_dir = f"{args.data_dir}/media" if args.data_dir else "media"
+
+    result = mf.download_media(toots, args.out_dir, max_workers=args.workers, max_per_host=args.per_host,
+                               request_timeout=args.request_timeout, verbose=True)
+    message = f"Downloaded {result['downloaded']} of {result['n_media']} media files of {result['n_toots']} toots to {args.out_dir}"
+    print(f'{message: <70}', end="\n")
+    if result["failed"]:
+        print(f"Could not download {result['failed']} media files, rerun to retry them")
+
+
 def date(s):
     return datetime.strptime(s, "%Y-%m-%d")
 
@@ -544,6 +1044,8 @@ def main():
         description="A tool to gather data from Mastodon",
         usage="mtb [-h] command [options]"
     )
+    parser.add_argument(
+        "--health_file", help="File with the health of every queried instance, shared by all commands (default: mtb_health.json)", default=mf.HEALTH_FILE, type=str)
 
     subparsers = parser.add_subparsers(
         title="commands",
@@ -569,6 +1071,12 @@ def main():
     parser_instances.add_argument("--max_followers", help="The maximum number of followers per user profile (default: 200)", default=200, type=int)
     parser_instances.add_argument("--save_followers", help="File to save the gathered follower accounts to",
                                   nargs="?", const="followers_meta.csv", type=argparse.FileType("w"))
+    parser_instances.add_argument(
+        "--workers", help="Number of accounts to crawl in parallel (default: 8)", default=8, type=int)
+    parser_instances.add_argument(
+        "--request_interval", help="Seconds between requests to the same instance (default: 1.5)", default=1.5, type=float)
+    parser_instances.add_argument(
+        "--account_store", help="Local database of seen accounts, shared by all commands (default: mtb_accounts.db)", default=mf.ACCOUNT_STORE, type=str)
 
     parser_instances.add_argument("--sort_by", help="Order or the requested instances", choices=[
                                   "name", "uptime", "https_score", "obs_score", "users", "statuses", "connections", "active_users"], default="active_users", type=str)
@@ -585,11 +1093,23 @@ def main():
         "--save_instances_meta", help="File to save instance metadata to", nargs="?", const="instances_meta.csv", type=str)
     parser_instances.add_argument(
         "--instances_file", help="File to save the list of instance to", default="instances.txt", type=str)
+    parser_instances.add_argument(
+        "--include_peers", help="Also save metadata of the instances' peers, found breadth first", action="store_true")
+    parser_instances.add_argument(
+        "--peers_depth", help="How many steps to follow peers from the initial instances (default: 1)", default=1, type=int)
+    parser_instances.add_argument(
+        "--max_instances", help="Stop adding peers when this many instances are known, 0 for no limit (default: 500)", default=500, type=int)
+    parser_instances.add_argument(
+        "--instance_store", help="Local database of instance metadata (default: mtb_instances.db)", default=mf.INSTANCE_STORE, type=str)
+    parser_instances.add_argument(
+        "--max_age", help="Reuse stored instance metadata younger than this many hours (default: 24)", default=24, type=float)
     parser_instances.set_defaults(func=run_instances)
 
     parser_hashtag = subparsers.add_parser(
         "hashtag", help="Continuously gather toots that contain a hashtag")
     parser_hashtag.add_argument("--tag", help="Hashtag to gather", type=str)
+    parser_hashtag.add_argument(
+        "--tags", help="File with hashtags to gather together, one per line", type=argparse.FileType("r"))
     parser_hashtag.add_argument(
         "--instances", help="File with urls to instances", type=argparse.FileType("r"))
     parser_hashtag.add_argument(
@@ -600,6 +1120,24 @@ def main():
         "--end_date", help="End data gathering at this date (YYYY-MM-DD)", type=date)
     parser_hashtag.add_argument(
         "--local_only", help="Only gather toots local to the queried instances", action="store_true")
+    parser_hashtag.add_argument(
+        "--track_engagement", help="Record the engagement counts of every observed toot in engagement.db", action="store_true")
+    parser_hashtag.add_argument(
+        "--dedup", help="Store every toot only once across instances and record further sightings in sightings.csv", action="store_true")
+    parser_hashtag.add_argument(
+        "--backfill", help="Fetch the range between --start_date and --end_date in parallel shards (resumable)", action="store_true")
+    parser_hashtag.add_argument(
+        "--shards", help="Number of ID shards per instance for --backfill (default: 8)", default=8, type=int)
+    parser_hashtag.add_argument(
+        "--workers", help="Number of parallel requests for --backfill (default: 8)", default=8, type=int)
+    parser_hashtag.add_argument(
+        "--per_host", help="Maximum parallel requests per instance for --backfill (default: 2)", default=2, type=int)
+    parser_hashtag.add_argument(
+        "--stream", help="Keep gathering from the streaming API after catching up, gaps are filled by polling", action="store_true")
+    parser_hashtag.add_argument(
+        "--timeframe", help="Stream for n seconds (default: until interrupted)", type=int)
+    parser_hashtag.add_argument(
+        "--flush_interval", help="Seconds between saving streamed toots to a new timelines file (default: 3600)", default=3600, type=int)
     parser_hashtag.set_defaults(func=run_hashtag)
 
     parser_users = subparsers.add_parser(
@@ -610,10 +1148,54 @@ def main():
         "--out_file", help="File to save user metadata to", default="accounts_meta.csv", type=str)
     parser_users.add_argument(
         "--parse_html", help="Convert html in toot content and user notes to clean text", action="store_true")
-    # parser_users.add_argument(
-    #     "--get_posts", help="Only gather toots local to the queried instances", action="store_true")
+    parser_users.add_argument(
+        "--workers", help="Number of instances to query in parallel (default: 8)", default=8, type=int)
+    parser_users.add_argument(
+        "--account_store", help="Local database of seen accounts, shared by all commands (default: mtb_accounts.db)", default=mf.ACCOUNT_STORE, type=str)
+    parser_users.add_argument(
+        "--max_age", help="Refetch accounts from the account store that are older than max_age hours (default: 24)", default=24, type=float)
+    parser_users.add_argument(
+        "--get_posts", help="Also gather the posts of the users, reruns only fetch new posts", action="store_true")
+    parser_users.add_argument(
+        "--posts_file", help="File to save the posts to (default: accounts_posts.csv)", default="accounts_posts.csv", type=str)
+    parser_users.add_argument(
+        "--max_posts", help="The maximum number of posts per user and run", type=int)
     parser_users.set_defaults(func=run_users)
 
+    parser_toots = subparsers.add_parser(
+        "toots", help="Get toots by their urls")
+    parser_toots.add_argument(
+        "--urls", help="File with urls or uris of toots", type=argparse.FileType("r"))
+    parser_toots.add_argument(
+        "--out_file", help="File to save the toots to (default: [timestamp]_toots.jsonl)", type=str)
+    parser_toots.add_argument(
+        "--format", help="Format of output file", choices=["json", "csv"], default="json", type=str)
+    parser_toots.add_argument(
+        "--parse_html", help="Convert html in toot content and user notes to clean text", action="store_true")
+    parser_toots.add_argument(
+        "--workers", help="Number of parallel requests (default: 16)", default=16, type=int)
+    parser_toots.add_argument(
+        "--per_host", help="Maximum parallel requests per instance (default: 4)", default=4, type=int)
+    parser_toots.add_argument(
+        "--status_store", help="Local database of resolved toots, known urls are not requested again (default: mtb_statuses.db)", default=mf.STATUS_STORE, type=str)
+    parser_toots.set_defaults(func=run_toots)
+
+    parser_media = subparsers.add_parser(
+        "media", help="Download the media attachments of gathered toots")
+    parser_media.add_argument(
+        "--toots", help="json-file with toots", type=argparse.FileType("r"))
+    parser_media.add_argument(
+        "--data_dir", help="Directory with gathered timelines", type=str)
+    parser_media.add_argument(
+        "--out_dir", help="Directory to save the media files and manifest to (default: [data_dir]/media)", type=str)
+    parser_media.add_argument(
+        "--workers", help="Number of parallel downloads (default: 16)", default=16, type=int)
+    parser_media.add_argument(
+        "--per_host", help="Maximum parallel downloads per host (default: 4)", default=4, type=int)
+    parser_media.add_argument(
+        "--request_timeout", help="Seconds to wait for a media server (default: 30)", default=30, type=int)
+    parser_media.set_defaults(func=run_media)
+
     parser_public = subparsers.add_parser(
         "public", help="Continuously gather (filtered) public toots")
     parser_public.add_argument(
@@ -626,6 +1208,20 @@ def main():
         "--local_only", help="Only gather toots local to the queried instances", action="store_true")
     parser_public.add_argument(
         "--filter", help="String to filter queried toots with", type=str)
+    parser_public.add_argument(
+        "--track_engagement", help="Record the engagement counts of every observed toot in engagement.db", action="store_true")
+    parser_public.add_argument(
+        "--dedup", help="Store every toot only once across instances and record further sightings in sightings.csv", action="store_true")
+    parser_public.add_argument(
+        "--end_date", help="End of the range for --backfill (YYYY-MM-DD)", type=date)
+    parser_public.add_argument(
+        "--backfill", help="Fetch the range between --start_date and --end_date in parallel shards (resumable)", action="store_true")
+    parser_public.add_argument(
+        "--shards", help="Number of ID shards per instance for --backfill (default: 8)", default=8, type=int)
+    parser_public.add_argument(
+        "--workers", help="Number of parallel requests for --backfill (default: 8)", default=8, type=int)
+    parser_public.add_argument(
+        "--per_host", help="Maximum parallel requests per instance for --backfill (default: 2)", default=2, type=int)
     parser_public.set_defaults(func=run_public)
 
     parser_sample = subparsers.add_parser(
@@ -648,6 +1244,14 @@ def main():
         "--filter", help="String to filter queried toots with", type=str)
     parser_sample.add_argument(
         "--local_only", help="Only gather toots local to the queried instances", action="store_true")
+    parser_sample.add_argument(
+        "--size", help="Keep a fixed-size reservoir sample of the live public streams", type=int)
+    parser_sample.add_argument(
+        "--stratify_by", help="Keep one reservoir per stratum", choices=["instance", "language", "hour"], default=None, type=str)
+    parser_sample.add_argument(
+        "--timeframe", help="Number of seconds to stream for (default: 3600)", default=3600, type=int)
+    parser_sample.add_argument(
+        "--flush_interval", help="Seconds between writing the sample to disk (default: 300)", default=300, type=int)
     parser_sample.set_defaults(func=run_sample)
 
     parser_interactions = subparsers.add_parser(
@@ -662,6 +1266,16 @@ def main():
         "--parse_html", help="Convert html in toot content and user notes to clean text", action="store_true")
     parser_interactions.add_argument(
         "--save_context_toots", help="Save the descendants and ancestors as csv", action="store_true")
+    parser_interactions.add_argument(
+        "--account_store", help="Local database of seen accounts, shared by all commands (default: mtb_accounts.db)", default=mf.ACCOUNT_STORE, type=str)
+    parser_interactions.add_argument(
+        "--previous", help="json-file of an earlier run to refresh, toots with unchanged counts are skipped", type=argparse.FileType("r"))
+    parser_interactions.add_argument(
+        "--stream", help="Write one record (json lines) or its rows (csv) per toot as soon as it is done", action="store_true")
+    parser_interactions.add_argument(
+        "--graph_dir", help="Also write the interactions as an integer-indexed graph (nodes.csv, edges.csv and csr_*.bin) to this directory", type=str)
+    parser_interactions.add_argument(
+        "--weighted", help="Aggregate graph edges by source, destination and kind into weights", action="store_true")
     parser_interactions.set_defaults(func=run_interactions)
 
     parser_trends = subparsers.add_parser(
@@ -670,6 +1284,14 @@ def main():
         "--instances", help="File with urls to instances", type=argparse.FileType("r"))
     parser_trends.add_argument(
         "--data_dir", help="Directory where gathered data is saved", type=str)
+    parser_trends.add_argument(
+        "--track_engagement", help="Record the engagement counts of every observed toot in engagement.db", action="store_true")
+    parser_trends.add_argument(
+        "--workers", help="Number of instances to query in parallel (default: 8)", default=8, type=int)
+    parser_trends.add_argument(
+        "--interval", help="Poll every n seconds and only save what changed since the last poll", type=int)
+    parser_trends.add_argument(
+        "--polls", help="Stop after n polls (default: poll until interrupted)", type=int)
     parser_trends.set_defaults(func=run_trends)
 
     parser_export = subparsers.add_parser("export", help="Export data")
@@ -684,6 +1306,16 @@ def main():
         "--parse_html", help="Convert html in toot content and user notes to clean text", action="store_true")
     parser_export.add_argument(
         "--aggregate", help="Aggregate toots over instances timelines", action="store_true")
+    parser_export.add_argument(
+        "--columns", help="Comma separated list of columns to export, only these are computed (default: all)", type=str)
+    parser_export.add_argument(
+        "--engagement", help="Export the engagement trajectories recorded with --track_engagement", action="store_true")
+    parser_export.add_argument(
+        "--partition_by", help="Comma separated keys (created_date, instance_name, language) to split the export into a key=value directory tree", type=str)
+    parser_export.add_argument(
+        "--out_dir", help="Directory for --partition_by (default: [timestamp]_export)", type=str)
+    parser_export.add_argument(
+        "--max_open_files", help="Number of partition files kept open at once for --partition_by (default: 64)", default=64, type=int)
     parser_export.set_defaults(func=run_export)
 
     parser_cleanup = subparsers.add_parser(
@@ -691,7 +1323,11 @@ def main():
     parser_cleanup.set_defaults(func=run_cleanup)
 
     args = parser.parse_args()
-    args.func(args)
+    mf.health.load(args.health_file)
+    try:
+        args.func(args)
+    finally:
+        mf.health.save()
 
 
 if __name__ == '__main__':